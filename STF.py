@@ -1,15 +1,30 @@
 """STF Scraper."""
-from concurrent.futures import as_completed, ThreadPoolExecutor
+from concurrent.futures import (FIRST_COMPLETED, Future, ThreadPoolExecutor,
+                                wait)
 from datetime import date, datetime
-from typing import Generator, List, Literal, Optional, Tuple
+from typing import (Dict, Generator, Iterable, Iterator, List, Literal,
+                    Optional, Sequence, Tuple)
+import hashlib
+import itertools
 import logging
+import queue
+import threading
 import lxml.html
-import psycopg2 as pg
-import re
 import yaml
-from utils.funcs import requester
+from utils.cache import CacheMiss
+from utils.funcs import (bounded_map, conditional_requester, requester,
+                         Validated)
+from utils.metrics import metrics, reporting
+from utils.parsers import (parse_details, parse_search, parse_tab,
+                           ProcessDetails, SearchRow)
+from utils.scheduler import IdScheduler, LeasedIdScheduler
+from db.db_bulk import BulkWriter
 from db.db_config import config
+from db.db_intern import Interner
+from db.db_leases import LeaseManager
+from db.db_pool import pooled_connection
 from db.db_testing import DBTester
+from db.db_writer import BatchWriter
 
 with open("utils/config.yml") as ymlfile:
     cfg = yaml.safe_load(ymlfile)
@@ -17,6 +32,60 @@ with open("utils/config.yml") as ymlfile:
 logging.basicConfig(
     format=cfg["log"]["format"], datefmt="%H:%M:%S", level=logging.INFO)
 
+_tab_pool: Optional[ThreadPoolExecutor] = None
+_tab_pool_lock = threading.Lock()
+
+
+def lease_manager(db_params: dict) -> LeaseManager:
+    """Return a lease manager configured by ``leases``."""
+    return LeaseManager(cfg["sql"]["leases"], db_params,
+                        expiry=cfg["leases"]["expiry"],
+                        maxconn=cfg["threads"]["max_workers"])
+
+
+def get_tab_pool() -> ThreadPoolExecutor:
+    """Return the pool shared by process scrapers to fetch detail tabs."""
+    global _tab_pool
+    if _tab_pool is None:
+        with _tab_pool_lock:
+            if _tab_pool is None:
+                _tab_pool = ThreadPoolExecutor(
+                    cfg["threads"]["max_workers"]
+                    * len(cfg["urls"]["details"]),
+                    thread_name_prefix="tabs")
+    return _tab_pool
+
+
+def prepare_data_table(db_params: dict) -> None:
+    """Create ``stf_data``, or add the columns an older one lacks."""
+    tester: DBTester = DBTester("stf_data", cfg["sql"]["data"]["create"],
+                                db_params)
+    for column, sql in cfg["sql"]["data"]["migrate"].items():
+        tester.migrate(column, sql)
+
+
+def batch_writer(db_params: dict) -> BatchWriter:
+    """Return the writer of scraped rows, bulk if set on ``database``."""
+    if not cfg["database"]["bulk"]:
+        return BatchWriter(db_params, cfg["database"]["batch_size"],
+                           cfg["threads"]["max_workers"])
+    sql: dict = cfg["sql"]
+    return BulkWriter({
+        sql["data"]["insert_batch"]: sql["bulk"]["data"]["insert"],
+        sql["data"]["update_batch"]["sql"]: sql["bulk"]["data"]["update"],
+        sql["scrap_log"]["insert_batch"]: sql["bulk"]["scrap_log"]},
+        db_params, cfg["database"]["bulk_batch_size"],
+        cfg["threads"]["max_workers"])
+
+
+def journal(kind: Literal["search", "details", "refresh"], scope: str,
+            id_: int, error: Exception, writer: BatchWriter) -> None:
+    """Buffer a failure of a search id or incident on ``stf_failures``."""
+    metrics.inc("failures_total", kind=kind)
+    entry: dict = cfg["sql"]["failures"]["journal"]
+    writer.add(entry["sql"], (kind, scope, id_, repr(error)),
+               key=(kind, scope, id_), template=entry["template"])
+
 
 class SearchScraper:
     """Scrap STF search based on a range of ids and write on database."""
@@ -26,18 +95,30 @@ class SearchScraper:
 
         ``self.code`` keeps the code provided on ``code`` mode.
 
-        ``self.step`` defines how many processes must be scraped on each run.
-        A value around ``200`` is recomended to reduce requests made to the
-        server.
+        ``self.step`` limits how many ids are scraped on each run. When it is
+        ``None`` the scraping goes on until ``scheduler.max_misses``
+        consecutive ids without processes are found.
+
+        Setting ``self.stopping`` ends a run once the ids in flight finish.
+        Stopped runs are not marked as done, so the next one resumes them.
         """
         logging.info("Initializing SearchScraper")
         self.db_params: dict = db_params if db_params is not None else config()
-        DBTester("stf_data", cfg["sql"]["data"]["create"], self.db_params)
+        prepare_data_table(self.db_params)
         DBTester("stf_scrap_log", cfg["sql"]["scrap_log"]["create"],
                  self.db_params)
+        DBTester("stf_failures", cfg["sql"]["failures"]["create"],
+                 self.db_params)
+        DBTester("stf_id_checkpoints", cfg["sql"]["checkpoints"]["create"],
+                 self.db_params).migrate(
+            "last_hit", cfg["sql"]["checkpoints"]["migrate"])
         self.code: Optional[str] = None
-        self.step: int = 200
+        self.scope: str = "max"
+        self.step: Optional[int] = None
+        self.urls: dict = cfg["urls"]
         self.now: date = datetime.now().date()
+        self.writer: BatchWriter = batch_writer(self.db_params)
+        self.stopping: threading.Event = threading.Event()
 
     def scrap_incidents(self, id_stf: int) -> None:
         """Extract incidents from search pages and write to the database.
@@ -51,63 +132,155 @@ class SearchScraper:
         write part of processes data to the database. The remaining columns
         will be filled by ``ProcessScraper.start()``.
         """
+        self._search(id_stf)
+
+    def search_url(self, id_stf: int) -> str:
+        """Return the search URL of ``id_stf``.
+
+        On ``code`` mode the portal is asked for processes of that code only,
+        and ``id_stf`` is a number of the code's own numbering.
+        """
+        return self.urls["search"].format(classe=self.code or "", num=id_stf)
+
+    def _fetch(self, id_stf: int) -> List[SearchRow]:
+        """Request and parse the search page of ``id_stf``."""
         # Disable this to avoid logging each ID scraped
         logging.info(f"Searching id {id_stf}")
         try:
             search_html: lxml.html.HtmlElement = requester(
-                cfg["urls"]["search"].format(num=id_stf))
+                self.search_url(id_stf), "search")
         except lxml.etree.ParserError:
             raise Exception(f"Invalid id_stf: {id_stf}")
-        items: List[lxml.html.HtmlElement] = search_html.xpath("//table/tr")
+        except CacheMiss:
+            # Replaying an id that was never scraped
+            return []
+
+        with metrics.timer("extract_seconds", page="search"):
+            rows: List[SearchRow] = parse_search(search_html, self.code)
+        metrics.inc("ids_total")
+        return rows
+
+    def _found(self, id_stf: int, rows: List[SearchRow]) -> bool:
+        """Buffer the rows found on ``id_stf`` and tell if there are any."""
+        if len(rows) == 0:
+            return False
+        metrics.inc("ids_with_processes_total")
+        self._write_incidents(id_stf, rows)
+        return True
+
+    def _search(self, id_stf: int) -> bool:
+        """Scrap incidents of ``id_stf`` and tell if any process was found."""
+        return self._found(id_stf, self._fetch(id_stf))
+
+    def _try_search(self, id_stf: int) -> bool:
+        """Scrap an id like ``_search``, journaling failures to fetch it.
 
-        if len(items) == 0:
+        Ids whose page fails to be fetched or parsed are written to
+        ``stf_failures`` and count as ids without processes, so the run goes
+        on. They are retried by later runs. Errors writing rows are raised
+        and stop the run.
+        """
+        try:
+            rows: List[SearchRow] = self._fetch(id_stf)
+        except Exception as error:
+            logging.exception(f"Failed to search id {id_stf}")
+            journal("search", self.scope, id_stf, error, self.writer)
+            return False
+        return self._found(id_stf, rows)
+
+    def _retry_holes(self) -> None:
+        """Search again the failed ids of ``self.scope``.
+
+        Ids are retried until ``failures.max_attempts`` attempts failed.
+        """
+        with pooled_connection(self.db_params,
+                               cfg["threads"]["max_workers"]) as conn, \
+                conn.cursor() as curs:
+            curs.execute(cfg["sql"]["failures"]["holes"], {
+                "scope": self.scope,
+                "max_attempts": cfg["failures"]["max_attempts"]})
+            holes: List[int] = [row[0] for row in curs.fetchall()]
+        if not holes:
             return
-        with pg.connect(**self.db_params) as conn, conn.cursor() as curs:
-            for item in items:
-                classe_processo_sigla: str = item.xpath(
-                    "./td[position()=1]/a/text()")[0].split(" ")[0]
-                # Only parse processes with given self.code
-                if self.code is not None \
-                        and classe_processo_sigla != self.code:
-                    continue
-
-                incidente: int = item.xpath(
-                    "./td[position()=1]/a/@href")[0].split("=")[1]
-                numero_unico: str = item.xpath("./td[position()=2]/text()")[0]\
-                    .replace(".", "").replace("-", "")
-
-                data_str: str = item.xpath(
-                    "./td[position()=3]/text()")[0]
-                data_protocolo: date = datetime.strptime(
-                    data_str, "%d/%m/%Y").date()
-
-                meio: str = item.xpath("./td[position()=4]/text()")[0]
-                if meio == "Físico":
-                    meio_id: int = 1
-                elif meio == "Eletrônico":
-                    meio_id = 2
-
-                tipo: str = item.xpath("./td[position()=5]/text()")[0]
-                if tipo == "Público":
-                    tipo_id: int = 1
-                elif tipo == "Segredo de Justiça":
-                    tipo_id = 2
-                elif tipo == "Sigiloso":
-                    tipo_id = 3
-
-                # Scrap log table
-                curs.execute(cfg["sql"]["scrap_log"]["insert"],
-                             (classe_processo_sigla, id_stf, self.now))
-                conn.commit()
-                # Data table
-                curs.execute(cfg["sql"]["data"]["insert"], (
-                    incidente, numero_unico, id_stf, classe_processo_sigla,
-                    data_protocolo, meio_id, tipo_id, self.now))
-                conn.commit()
+        logging.info(f"Retrying {len(holes)} failed ids")
+        resolve: dict = cfg["sql"]["failures"]["resolve"]
+
+        def retry(id_stf: int) -> None:
+            try:
+                rows: List[SearchRow] = self._fetch(id_stf)
+            except Exception as error:
+                logging.exception(f"Failed to search id {id_stf} again")
+                journal("search", self.scope, id_stf, error, self.writer)
+                return
+            self._found(id_stf, rows)
+            self.writer.add(resolve["sql"], ("search", self.scope, id_stf),
+                            key=id_stf, template=resolve["template"])
+
+        with ThreadPoolExecutor(cfg["threads"]["max_workers"]) as exec:
+            for _ in bounded_map(exec, retry, holes,
+                                 cfg["threads"]["max_workers"]
+                                 * cfg["threads"]["queue_size"]):
+                pass
+
+    def _resume(self) -> Optional[Tuple[int, Optional[int]]]:
+        """Return where the last run of ``self.scope`` stopped, if it did.
+
+        The last id it found processes in is returned along with it.
+        """
+        with pooled_connection(self.db_params,
+                               cfg["threads"]["max_workers"]) as conn, \
+                conn.cursor() as curs:
+            curs.execute(cfg["sql"]["checkpoints"]["resume"],
+                         {"scope": self.scope})
+            row: Optional[Tuple[int, Optional[int]]] = curs.fetchone()
+        return row
+
+    def _checkpoint(self, scheduler: IdScheduler) -> None:
+        """Buffer the range of ids finished since the start of the run.
+
+        It is written with the rows of the ids it covers, so a run stopped at
+        any time is resumed from the first id that was not written.
+        """
+        if isinstance(scheduler, LeasedIdScheduler):
+            # Leased ranges are tracked by their leases
+            return
+        advance: dict = cfg["sql"]["checkpoints"]["advance"]
+        self.writer.add(advance["sql"], (
+            self.scope, scheduler.start, scheduler.frontier,
+            scheduler.last_hit),
+            key=(self.scope, scheduler.start), template=advance["template"])
+
+    def _complete(self) -> None:
+        """Mark runs of ``self.scope`` as done, so they are not resumed."""
+        with pooled_connection(self.db_params,
+                               cfg["threads"]["max_workers"]) as conn, \
+                conn.cursor() as curs:
+            curs.execute(cfg["sql"]["checkpoints"]["complete"],
+                         {"scope": self.scope})
+
+    def _write_incidents(self, id_stf: int, rows: List[SearchRow]) -> None:
+        """Buffer search rows of ``id_stf`` and the scrap log update.
+
+        Rows are written in batches by ``self.writer``. Scrap log updates of
+        each class are collapsed to the highest id of the batch.
+        """
+        for row in rows:
+            # Scrap log table
+            self.writer.add(
+                cfg["sql"]["scrap_log"]["insert_batch"],
+                (row.classe_processo_sigla, id_stf, self.now),
+                key=row.classe_processo_sigla)
+            # Data table
+            self.writer.add(cfg["sql"]["data"]["insert_batch"], (
+                row.incidente, row.numero_unico, id_stf,
+                row.classe_processo_sigla, row.data_protocolo, row.meio_id,
+                row.tipo_id, self.now))
 
     def calc_start(self, mode: Literal["min", "max", "code"]) -> int:
         """Calculate starting id based on the scraping mode."""
-        with pg.connect(**self.db_params) as conn, conn.cursor() as curs:
+        with pooled_connection(self.db_params,
+                               cfg["threads"]["max_workers"]) as conn, \
+                conn.cursor() as curs:
             if mode == "max":
                 curs.execute(
                     cfg["sql"]["scrap_log"]["select"]["id"]["highest"])
@@ -126,7 +299,7 @@ class SearchScraper:
 
     def start(self, *,
               mode: Literal["min", "max", "code"],
-              code: str = None) -> bool:
+              code: str = None, leased: bool = False) -> bool:
         """Calculate start id, run scrap pool and check retrieved data.
 
         There are three modes available to extract data from STF search:
@@ -135,19 +308,45 @@ class SearchScraper:
         ``code`` starts from the highest id scraped of a given code.
 
         Use ``max`` mode if this is the first run.
+
+        ``leased`` takes ids in ranges leased from the database, so the same
+        mode can run on several processes or machines at once.
         """
         self.code = code
         if mode == "code" and self.code is None:
             raise ValueError(
                 "'code' parameter must not be None on 'code' mode.")
 
+        self.scope = self.code if mode == "code" else mode
         start: int = self.calc_start(mode)
-        ids = range(start, start+self.step)
-        with ThreadPoolExecutor(cfg["threads"]["max_workers"]) as exec:
-            futures = (exec.submit(self.scrap_incidents, id)
-                       for id in ids)
-            for future in as_completed(futures):
-                future.result()
+        scheduler: IdScheduler
+        if leased:
+            leases: LeaseManager = lease_manager(self.db_params)
+            leases.reset(self.scope)
+            scheduler = LeasedIdScheduler(
+                leases, self.scope, start, cfg["threads"]["max_workers"],
+                cfg["scheduler"]["max_misses"], cfg["leases"]["range_size"],
+                cfg["leases"]["poll_interval"], self.step)
+        else:
+            resumed: Optional[Tuple[int, Optional[int]]] = self._resume()
+            last_hit: int = start - 1
+            if resumed is not None:
+                logging.info(f"Resuming interrupted run from id {resumed[0]}")
+                # Misses are counted from the last hit of either run
+                if resumed[1] is not None:
+                    last_hit = max(last_hit, resumed[1])
+                start = resumed[0]
+            scheduler = IdScheduler(
+                start, cfg["threads"]["max_workers"],
+                cfg["scheduler"]["max_misses"], self.step, last_hit)
+        with reporting():
+            try:
+                self._retry_holes()
+                self._run(scheduler)
+            finally:
+                self.writer.flush()
+        if not leased and not self.stopping.is_set():
+            self._complete()
 
         # This can be used to stop recursion when no more data can be found
         after_update: int = self.calc_start(mode)
@@ -158,6 +357,31 @@ class SearchScraper:
         else:
             return True
 
+    def _run(self, scheduler: IdScheduler) -> None:
+        """Scrap ids given by ``scheduler`` on a thread pool.
+
+        A new id is submitted as soon as a worker is free, so the pool never
+        drains while the scheduler has ids to give.
+        """
+        with ThreadPoolExecutor(cfg["threads"]["max_workers"]) as exec:
+            futures: Dict[Future, int] = {}
+            while True:
+                while len(futures) < scheduler.max_in_flight \
+                        and not self.stopping.is_set():
+                    id_stf: Optional[int] = scheduler.next()
+                    if id_stf is None:
+                        break
+                    futures[exec.submit(self._try_search, id_stf)] = id_stf
+                if not futures:
+                    break
+                done, _ = wait(futures, return_when=FIRST_COMPLETED)
+                for future in done:
+                    scheduler.finish(futures.pop(future), future.result())
+                self._checkpoint(scheduler)
+        logging.info(f"Scraped ids {scheduler.start} to "
+                     f"{scheduler.next_id - 1}, {scheduler.hits} with "
+                     "processes")
+
 
 class ProcessScraper:
     """Scrap detailed processes data."""
@@ -165,110 +389,374 @@ class ProcessScraper:
     def __init__(self, db_params: dict = None):
         """Initialize state, test ``stf_data`` table.
 
-        All fields required by the database are added to the state for a better
-        control of type hinting.
+        Parsed data is kept in a ``ProcessDetails`` record per incident, so
+        workers do not share any state. ``self.tab_pool`` fetches the three
+        tabs of an incident at once, and is shared by all scrapers.
         """
-        self.classe_processo: str = ""
-        self.partes: List[Tuple[str, str]] = []
-        self.assuntos: List[str] = []
-        self.orgao_origem: str = ""
-        self.origem: str = ""
-        self.numeros_origem: List[str] = []
         self.scrap_date: date = datetime.now().date()
+        self.urls: dict = cfg["urls"]
         self.db_params: dict = db_params if db_params is not None else config()
-        DBTester("stf_data", cfg["sql"]["data"]["create"], self.db_params)
-
-    def _parse_process(self, incidente: int) -> None:
-        """Parse 'process' page."""
-        # Dados gerais
-        processo_html: lxml.html.HtmlElement = requester(
-            cfg["urls"]["details"]["process"].format(incidente=incidente))
-
-        classe_processo: str = processo_html.xpath(
-            cfg["xpath"]["process"]["classe_processo"])
-        self.classe_processo = classe_processo if len(classe_processo) else ""
-
-    def _parse_parts(self, incidente: int) -> None:
-        """Parse 'parts' page."""
-        # Partes do processo
-        partes_html: lxml.html.HtmlElement = requester(
-            cfg["urls"]["details"]["parties"].format(incidente=incidente))
-        partes_list: List[lxml.html.HtmlElement] = partes_html.xpath(
-            cfg["xpath"]["process"]["partes_list"])
-        if len(partes_list):
-            for parte in partes_list:
-                tipo: str = parte.xpath(
-                    "./div[@class='detalhe-parte']/text()")[0]
-                nome: str = parte.xpath("./div[@class='nome-parte']/text()")[0]
-                self.partes.append((tipo, nome))
-
-    def _parse_incident(self, incidente: int) -> None:
-        """Parse 'incident' page."""
-        # Detalhes do processo
-        detalhes_html: lxml.html.HtmlElement = requester(
-            cfg["urls"]["details"]["infos"].format(incidente=incidente))
-        assuntos: List[lxml.html.HtmlElement] = detalhes_html.xpath(
-            "//ul[@style='list-style:none;']/li")
-        if len(assuntos):
-            for assunto in assuntos:
-                assunto = assunto.xpath("text()")[0]
-                assunto_items: List[str] = assunto \
-                    .replace("||", "|").split("|")
-                self.assuntos.append("; ".join(assunto.strip()
-                                               for assunto in assunto_items))
-
-        # A positional approach could be used but the tags positions might not
-        # be the same across all processes.
-
-        # Looks for tags that contain the 'Origem:' text
-        for item in detalhes_html.xpath("//*[text()[contains(.,':')]]"):
-            # If it is an exact match
-            if item.xpath("./text()")[0].strip() == "Data de Protocolo:":
-                # Get next sibiling's text
-                raw_date = item.getnext().xpath("text()")[0].strip()
-                if raw_date != "":
-                    self.data_protocolo = datetime \
-                        .strptime(raw_date, "%d/%m/%Y").date()
-
-            if item.xpath("./text()")[0].strip() == "Órgão de Origem:":
-                self.orgao_origem = item.getnext().xpath("text()")[0].strip()
-
-            if item.xpath("./text()")[0].strip() == "Origem:":
-                self.origem = item.getnext().xpath("text()")[0].strip()
-
-            if item.xpath("./text()")[0].strip() == "Número de Origem:":
-                nums = item.getnext().xpath("text()")[0]
-                self.numeros_origem = re.sub(r"[\n\t\s]*", "", nums).split(",")
-                if(len(self.numeros_origem[0])) == 0:
-                    self.numeros_origem = []
+        prepare_data_table(self.db_params)
+        DBTester("stf_tab_state", cfg["sql"]["tab_state"]["create"],
+                 self.db_params)
+        DBTester("stf_failures", cfg["sql"]["failures"]["create"],
+                 self.db_params)
+        self.writer: BatchWriter = batch_writer(self.db_params)
+        self.tab_pool: ThreadPoolExecutor = get_tab_pool()
+        self.interners: Dict[str, Interner] = {
+            name: Interner(sql, self.db_params, cfg["database"]["intern_size"],
+                           cfg["threads"]["max_workers"])
+            for name, sql in cfg["sql"]["dimensions"].items()}
+        for relation in cfg["sql"]["relations"].values():
+            DBTester(relation["table"], relation["create"], self.db_params)
+
+    def fetch_details(self, incidente: int) -> ProcessDetails:
+        """Request the three tabs of a process concurrently and parse them."""
+        urls: dict = self.urls["details"]
+        tabs: List[Future] = [
+            self.tab_pool.submit(requester, urls[tab].format(
+                incidente=incidente), "details")
+            for tab in ("process", "parties", "infos")]
+        pages: List[lxml.html.HtmlElement] = [tab.result() for tab in tabs]
+        with metrics.timer("extract_seconds", page="details"):
+            return parse_details(incidente, *pages)
 
     def scrap_process(self, incidente: int) -> None:
         """Scrap process and save parsed data."""
         logging.info(f"Saving details from {incidente}")
-        self._parse_process(incidente)
-        self._parse_parts(incidente)
-        self._parse_incident(incidente)
-
+        try:
+            details: ProcessDetails = self.fetch_details(incidente)
+        except CacheMiss as miss:
+            logging.warning(f"Skipping {incidente}, not cached: {miss}")
+            return
+        except Exception as error:
+            logging.exception(f"Failed to scrap {incidente}")
+            self._fail_process(incidente, error)
+            return
+        metrics.inc("incidents_total")
+        self._write_details(details)
+
+    def _write_details(self, details: ProcessDetails) -> None:
+        """Buffer the detailed data of a process and its relations."""
+        self._write_process(details.payload(self.scrap_date))
+        self._write_relations(details.incidente, partes=details.partes,
+                              assuntos=details.assuntos,
+                              numeros_origem=details.numeros_origem)
+
+    def _write_process(self, payload: tuple) -> None:
+        """Buffer the update of a process with its detailed data."""
         # Lists must be converted to strings before writing to DB for now
-        with pg.connect(**self.db_params) as conn, conn.cursor() as curs:
-            payload = (self.classe_processo, self.partes, self.assuntos,
-                       self.orgao_origem, self.origem, self.numeros_origem,
-                       self.scrap_date, incidente)
-            curs.execute(cfg["sql"]["data"]["update"], payload)
-            conn.commit()
-
-    def retrive_incidents(self) -> Generator[Tuple[int], None, None]:
-        """Yield incidents that don't have any detailed data from DB."""
-        with pg.connect(**self.db_params) as conn, conn.cursor() as curs:
-            curs.execute(cfg["sql"]["data"]["select"]["incomplete"])
+        update: dict = cfg["sql"]["data"]["update_batch"]
+        self.writer.add(update["sql"], payload, template=update["template"])
+
+    def _write_relations(
+            self, incidente: int,
+            partes: Optional[Sequence[Tuple[str, str]]] = None,
+            assuntos: Optional[Sequence[str]] = None,
+            numeros_origem: Optional[Sequence[str]] = None) -> None:
+        """Buffer the parties, subjects and origin numbers of a process.
+
+        Values are written as ids of the ``sql.dimensions`` tables, replacing
+        the rows of the process on ``sql.relations`` tables. Relations that
+        are not given are kept.
+        """
+        relations: dict = cfg["sql"]["relations"]
+        rows: Dict[str, tuple] = {}
+        if partes is not None:
+            rows["parties"] = (
+                incidente,
+                self.interners["roles"].ids([tipo for tipo, _ in partes]),
+                self.interners["parties"].ids([nome for _, nome in partes]))
+        if assuntos is not None:
+            rows["subjects"] = (incidente,
+                                self.interners["subjects"].ids(assuntos))
+        if numeros_origem is not None:
+            rows["origins"] = (incidente,
+                               self.interners["origins"].ids(numeros_origem))
+        for name, row in rows.items():
+            write: dict = relations[name]["write"]
+            # A process is written once per batch, with its latest values
+            self.writer.add(write["sql"], row, key=incidente,
+                            template=write["template"], latest=True)
+
+    def _fail_process(self, incidente: int, error: Exception) -> None:
+        """Buffer a failed attempt to scrap a process and journal its error.
+
+        Processes that failed ``failures.max_attempts`` times are marked as
+        failed and no longer selected as incomplete.
+        """
+        journal("details", "", incidente, error, self.writer)
+        fail: dict = cfg["sql"]["data"]["fail_batch"]
+        self.writer.add(fail["sql"], (
+            incidente, cfg["failures"]["max_attempts"],
+            cfg["failures"]["retry_delay"]), template=fail["template"])
+
+    def retrive_incidents(self, select: Literal["incomplete", "all_incidents"]
+                          = "incomplete") -> Generator[Tuple[int], None, None]:
+        """Yield pending incidents, which don't have detailed data, from DB.
+
+        ``select="all_incidents"`` yields every incident instead.
+
+        A server-side cursor fetches ``database.fetch_size`` rows at a time,
+        so memory does not grow with the number of incidents.
+        """
+        with pooled_connection(self.db_params,
+                               cfg["threads"]["max_workers"]) as conn, \
+                conn.cursor(name=f"{select}_cursor") as curs:
+            curs.itersize = cfg["database"]["fetch_size"]
+            curs.execute(cfg["sql"]["data"]["select"][select])
             yield from curs
 
-    def start(self) -> bool:
-        """Scrap data and fill incomplete processes."""
-        with ThreadPoolExecutor(cfg["threads"]["max_workers"]) as exec:
-            futures = (exec.submit(self.scrap_process, i[0])
-                       for i in self.retrive_incidents())
-            for future in as_completed(futures):
-                future.result()
+    def lease_incidents(self, leases: LeaseManager
+                        ) -> Generator[int, None, None]:
+        """Yield incomplete incidents leased in batches from ``leases``."""
+        while batch := leases.claim_incidents(cfg["leases"]["batch_size"]):
+            yield from batch
 
+    def start(self, *, reparse: bool = False, leased: bool = False) -> bool:
+        """Scrap data and fill incomplete processes.
+
+        ``reparse`` scraps all processes again. Use it with the response cache
+        on ``replay`` mode to fill corrected columns from stored pages after
+        fixing a parser.
+
+        ``leased`` takes incidents in batches leased from the database, so
+        several processes or machines can fill processes at once.
+        """
+        if reparse and leased:
+            raise ValueError("Only incomplete processes can be leased.")
+        incidents: Iterable[int]
+        if leased:
+            incidents = self.lease_incidents(lease_manager(self.db_params))
+        else:
+            select: str = "all_incidents" if reparse else "incomplete"
+            incidents = (i[0] for i in self.retrive_incidents(select))
+        with reporting():
+            try:
+                self._run(incidents)
+            finally:
+                self.writer.flush()
+        self._resolve_failures()
         return True
+
+    def _resolve_failures(self) -> None:
+        """Drop journaled errors of processes scraped since they failed."""
+        with pooled_connection(self.db_params,
+                               cfg["threads"]["max_workers"]) as conn, \
+                conn.cursor() as curs:
+            curs.execute(cfg["sql"]["failures"]["resolve_done"])
+
+    def retrive_stale(self, min_age: int, limit: int
+                      ) -> Generator[Tuple[int, Optional[dict]], None, None]:
+        """Yield complete incidents checked ``min_age`` days ago or more.
+
+        Incidents come with the hash and validators of each tab, when known,
+        and the most stale come first. Incidents that failed to refresh are
+        held back as failed processes are by ``failures``.
+        """
+        with pooled_connection(self.db_params,
+                               cfg["threads"]["max_workers"]) as conn, \
+                conn.cursor(name="stale_cursor") as curs:
+            curs.itersize = cfg["database"]["fetch_size"]
+            curs.execute(cfg["sql"]["data"]["refresh"]["select"],
+                         {"min_age": min_age, "limit": limit,
+                          "max_attempts": cfg["failures"]["max_attempts"],
+                          "retry_delay": cfg["failures"]["retry_delay"]})
+            yield from curs
+
+    def refresh_process(self, stale: Tuple[int, Optional[dict]]) -> None:
+        """Check the tabs of a process and save the ones that changed.
+
+        Tabs are requested with the validators of their last response, so the
+        portal may answer that they are unchanged. Otherwise the parsed values
+        of each tab are hashed and only written when their hash differs from
+        the stored one. Hashing values instead of pages ignores changes to
+        markup alone.
+
+        Processes whose tabs fail to be fetched or parsed are journaled and
+        left untouched, to be checked again by a later refresh. Their journal
+        entries are dropped once they are refreshed.
+        """
+        incidente, tabs = stale
+        tabs = tabs if tabs is not None else {}
+        logging.info(f"Refreshing {incidente}")
+        urls: dict = self.urls["details"]
+        futures: Dict[str, Future] = {
+            tab: self.tab_pool.submit(
+                conditional_requester,
+                urls[tab].format(incidente=incidente), "details",
+                tabs.get(tab, {}).get("etag"),
+                tabs.get(tab, {}).get("last_modified"))
+            for tab in urls}
+        pages: Dict[str, Tuple[Validated, Optional[tuple]]] = {}
+        try:
+            for tab, future in futures.items():
+                page: Validated = future.result()
+                values: Optional[tuple] = None
+                if page.html is not None:
+                    with metrics.timer("extract_seconds", page=tab):
+                        values = parse_tab(tab, page.html)
+                pages[tab] = page, values
+        except CacheMiss as miss:
+            logging.warning(f"Skipping {incidente}, not cached: {miss}")
+            return
+        except Exception as error:
+            logging.exception(f"Failed to refresh {incidente}")
+            journal("refresh", "", incidente, error, self.writer)
+            return
+        finally:
+            # Tabs of a skipped process must not be requested after it
+            for future in futures.values():
+                future.cancel()
+            wait(futures.values())
+        for tab, (page, values) in pages.items():
+            state: dict = tabs.get(tab, {})
+            digest: Optional[str] = state.get("hash")
+            if values is not None:
+                # Values of stable types have a stable representation
+                page_digest: str = hashlib.sha1(
+                    repr(values).encode("utf-8")).hexdigest()
+                if page_digest != digest:
+                    metrics.inc("tabs_changed_total", tab=tab)
+                    update: dict = cfg["sql"]["data"]["refresh"]["update"][
+                        tab]
+                    self.writer.add(update["sql"],
+                                    values + (self.scrap_date, incidente),
+                                    template=update["template"])
+                    if tab == "parties":
+                        self._write_relations(incidente, partes=values[0])
+                    elif tab == "infos":
+                        self._write_relations(incidente, assuntos=values[0],
+                                              numeros_origem=values[3])
+                digest = page_digest
+            self.writer.add(cfg["sql"]["tab_state"]["upsert_batch"], (
+                incidente, tab, digest, page.etag or state.get("etag"),
+                page.last_modified or state.get("last_modified"),
+                self.scrap_date))
+        resolve: dict = cfg["sql"]["failures"]["resolve"]
+        self.writer.add(resolve["sql"], ("refresh", "", incidente),
+                        key=incidente, template=resolve["template"])
+        metrics.inc("incidents_refreshed_total")
+
+    def refresh(self, *, min_age: Optional[int] = None,
+                limit: Optional[int] = None) -> bool:
+        """Scrap complete processes again, the most stale first.
+
+        ``min_age`` and ``limit`` default to ``refresh.min_age`` and
+        ``refresh.limit``. Only tabs that changed are written.
+        """
+        stale: Iterable[Tuple[int, Optional[dict]]] = self.retrive_stale(
+            min_age if min_age is not None else cfg["refresh"]["min_age"],
+            limit if limit is not None else cfg["refresh"]["limit"])
+        with reporting():
+            try:
+                with ThreadPoolExecutor(cfg["threads"]["max_workers"]) \
+                        as exec:
+                    for _ in bounded_map(exec, self.refresh_process, stale,
+                                         cfg["threads"]["max_workers"]
+                                         * cfg["threads"]["queue_size"]):
+                        pass
+            finally:
+                self.writer.flush()
+        return True
+
+    def _run(self, incidents: Iterable[int]) -> None:
+        """Scrap all ``incidents`` on a thread pool.
+
+        Incidents are pulled as workers free up, keeping at most
+        ``threads.queue_size`` pending per worker.
+        """
+        with ThreadPoolExecutor(cfg["threads"]["max_workers"]) as exec:
+            for _ in bounded_map(exec, self.scrap_process, incidents,
+                                 cfg["threads"]["max_workers"]
+                                 * cfg["threads"]["queue_size"]):
+                pass
+
+
+class Pipeline:
+    """Scrap search pages and details of the processes found at once.
+
+    Incidents inserted by the search scraper are queued to the process
+    scraper's workers as soon as each batch is committed, so both stages run
+    concurrently and no table scan is needed to find new work. Incomplete
+    processes left by earlier runs are read from the database only once,
+    when the pipeline starts.
+    """
+
+    def __init__(self, db_params: dict = None) -> None:
+        """Initialize both scrapers and the queue linking them."""
+        self.search_scraper: SearchScraper = SearchScraper(db_params)
+        self.process_scraper: ProcessScraper = ProcessScraper(db_params)
+        self.queue: "queue.Queue[Optional[int]]" = queue.Queue(
+            cfg["pipeline"]["queue_size"])
+        self._details: Optional[Future] = None
+        self.search_scraper.writer.on_returning(
+            cfg["sql"]["data"]["insert_batch"], self._queue_inserted)
+
+    def _put(self, incidente: Optional[int]) -> None:
+        """Queue an incident, waiting while process workers are busy.
+
+        Incidents are dropped once process workers stopped; they are left
+        incomplete and scraped by later runs.
+        """
+        while not self._details.done():
+            try:
+                self.queue.put(incidente, timeout=1)
+                return
+            except queue.Full:
+                pass
+
+    def _queue_inserted(self, rows: List[Tuple[int]]) -> None:
+        """Queue incidents inserted by the search scraper."""
+        for row in rows:
+            self._put(row[0])
+
+    def _queued(self) -> Generator[int, None, None]:
+        """Yield queued incidents until the search is done."""
+        while (incidente := self.queue.get()) is not None:
+            yield incidente
+
+    def _scrap_details(self, incidents: Iterable[int]) -> None:
+        """Scrap ``incidents`` and write what is left of them."""
+        try:
+            self.process_scraper._run(incidents)
+        finally:
+            self.process_scraper.writer.flush()
+
+    def start(self, *, mode: Literal["min", "max", "code"],
+              code: str = None) -> bool:
+        """Run a search and scrap the details of the processes it finds.
+
+        Takes the modes and returns the value of ``SearchScraper.start``.
+        The search is stopped if process workers fail, and their error is
+        raised.
+        """
+        incomplete: Iterator[Tuple[int]] = \
+            self.process_scraper.retrive_incidents("incomplete")
+        # Opening the cursor fixes its results before the search writes
+        first: Optional[Tuple[int]] = next(incomplete, None)
+        recovered: Iterable[Tuple[int]] = incomplete if first is None \
+            else itertools.chain([first], incomplete)
+        self.search_scraper.stopping.clear()
+        try:
+            with ThreadPoolExecutor(1, thread_name_prefix="details") as exec:
+                self._details = exec.submit(
+                    self._scrap_details, itertools.chain(
+                        (i[0] for i in recovered), self._queued()))
+                self._details.add_done_callback(
+                    lambda _: self.search_scraper.stopping.set())
+                try:
+                    found: bool = self.search_scraper.start(mode=mode,
+                                                            code=code)
+                finally:
+                    # Ends the queue
+                    self._put(None)
+                    error: Optional[BaseException] = \
+                        self._details.exception()
+                    if error is not None:
+                        raise error
+        finally:
+            # Set once process workers end, even on success. Callbacks have
+            # run when the pool is shut down.
+            self.search_scraper.stopping.clear()
+        return found
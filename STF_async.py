@@ -0,0 +1,259 @@
+"""Asynchronous STF Scraper.
+
+Alternatives to ``STF.SearchScraper`` and ``STF.ProcessScraper`` that run
+hundreds of requests on a single event loop instead of a thread pool. Pages
+are parsed by the same parsers and written to the same tables.
+"""
+from typing import Dict, Iterable, List, Optional
+import asyncio
+import logging
+import time
+import aiohttp
+import lxml.html
+from STF import cfg, journal, ProcessScraper, SearchScraper
+from utils.cache import CacheMiss
+from utils.funcs import (cached, Endpoint, get_cache, get_governor,
+                         PageParser, parse_html, record_response, retry_delay,
+                         store)
+from utils.governor import Governor
+from utils.metrics import metrics
+from utils.parsers import (parse_details, parse_search, ProcessDetails,
+                           SearchRow)
+from utils.scheduler import IdScheduler
+
+
+def client_session() -> aiohttp.ClientSession:
+    """Open a keep-alive HTTP session capped at ``max_in_flight`` requests."""
+    return aiohttp.ClientSession(
+        headers=cfg["requests"]["headers"],
+        connector=aiohttp.TCPConnector(
+            limit=cfg["async"]["max_in_flight"]),
+        timeout=aiohttp.ClientTimeout(total=cfg["requests"]["timeout"]))
+
+
+async def async_requester(session: aiohttp.ClientSession, url: str,
+                          endpoint: Endpoint = "search"
+                          ) -> lxml.html.HtmlElement:
+    """Do request and return the parsed HTML response.
+
+    Requests go through the endpoint's governor and are retried as in
+    ``utils.funcs.fetch``, and pages are parsed as they stream in. Pages are
+    read from and stored to the response cache depending on its mode.
+    """
+    content: Optional[bytes] = cached(url)
+    if content is not None:
+        return parse_html(content)
+
+    governor: Governor = get_governor(endpoint)
+    keep: bool = get_cache().mode == "record"
+    attempt: int = 0
+    while True:
+        await governor.acquire_async()
+        started: float = time.monotonic()
+        page: PageParser = PageParser(keep)
+        try:
+            async with session.get(url) as res:
+                if res.ok:
+                    async for chunk in res.content.iter_chunked(
+                            cfg["requests"]["chunk_size"]):
+                        page.feed(chunk)
+        except (aiohttp.ClientConnectionError, aiohttp.ClientPayloadError,
+                asyncio.TimeoutError) as error:
+            latency: float = time.monotonic() - started
+            governor.release(latency, ok=False)
+            record_response(endpoint, latency, type(error).__name__,
+                            page.size)
+            failure: str = repr(error)
+            delay: Optional[float] = retry_delay(attempt)
+            if delay is None:
+                metrics.inc("http_errors_total", endpoint=endpoint)
+                raise
+        except BaseException:
+            # Parse errors and cancelled tasks must free the slot as well
+            governor.release(time.monotonic() - started, ok=True)
+            raise
+        else:
+            latency = time.monotonic() - started
+            failed: bool = res.status \
+                in cfg["requests"]["retries"]["status_forcelist"]
+            governor.release(latency, ok=not failed)
+            record_response(endpoint, latency, str(res.status), page.size)
+            if not failed:
+                res.raise_for_status()
+                if keep:
+                    store(url, page.content)
+                return page.close()
+            failure = f"status {res.status}"
+            delay = retry_delay(attempt)
+            if delay is None:
+                metrics.inc("http_errors_total", endpoint=endpoint)
+                res.raise_for_status()
+        metrics.inc("http_retries_total", endpoint=endpoint)
+        logging.warning(f"Retrying {url} in {delay:.1f}s after {failure}")
+        await asyncio.sleep(delay)
+        attempt += 1
+
+
+async def run_workers(worker, items: Iterable) -> None:
+    """Feed ``items`` to ``max_in_flight`` coroutines of ``worker``.
+
+    Items are pulled lazily, so only the requests in flight are kept in memory.
+    Pulling may block on the database, as when reading a server-side cursor or
+    leasing incidents, so items are pulled one at a time on the loop's default
+    executor. The first exception cancels the remaining workers and is raised.
+    """
+    items = iter(items)
+    loop: asyncio.AbstractEventLoop = asyncio.get_running_loop()
+    pulling: asyncio.Lock = asyncio.Lock()
+    exhausted: object = object()
+
+    async def consume() -> None:
+        while True:
+            async with pulling:
+                item = await loop.run_in_executor(None, next, items,
+                                                  exhausted)
+            if item is exhausted:
+                return
+            await worker(item)
+
+    tasks: List[asyncio.Task] = [asyncio.ensure_future(consume())
+                                 for _ in range(cfg["async"]["max_in_flight"])]
+    try:
+        await asyncio.gather(*tasks)
+    finally:
+        for task in tasks:
+            task.cancel()
+
+
+class AsyncSearchScraper(SearchScraper):
+    """Scrap STF search on an event loop and write on database.
+
+    ``start`` keeps the modes and return values of ``SearchScraper.start``.
+    """
+
+    async def scrap_incidents_async(self, session: aiohttp.ClientSession,
+                                    id_stf: int) -> bool:
+        """Extract incidents from a search page and write to the database.
+
+        Tells if any process was found.
+        """
+        rows: List[SearchRow] = await self._fetch_async(session, id_stf)
+        # psycopg2 blocks, so writes run on the loop's default executor
+        return await asyncio.get_running_loop().run_in_executor(
+            None, self._found, id_stf, rows)
+
+    async def _fetch_async(self, session: aiohttp.ClientSession,
+                           id_stf: int) -> List[SearchRow]:
+        """Request and parse the search page of ``id_stf``."""
+        logging.info(f"Searching id {id_stf}")
+        try:
+            search_html: lxml.html.HtmlElement = await async_requester(
+                session, self.search_url(id_stf))
+        except lxml.etree.ParserError:
+            raise Exception(f"Invalid id_stf: {id_stf}")
+        except CacheMiss:
+            # Replaying an id that was never scraped
+            return []
+
+        with metrics.timer("extract_seconds", page="search"):
+            rows: List[SearchRow] = parse_search(search_html, self.code)
+        metrics.inc("ids_total")
+        return rows
+
+    async def _try_search_async(self, session: aiohttp.ClientSession,
+                                id_stf: int) -> bool:
+        """Scrap an id, journaling failures to fetch it as ``_try_search``."""
+        loop: asyncio.AbstractEventLoop = asyncio.get_running_loop()
+        try:
+            rows: List[SearchRow] = await self._fetch_async(session, id_stf)
+        except Exception as error:
+            logging.exception(f"Failed to search id {id_stf}")
+            await loop.run_in_executor(
+                None, journal, "search", self.scope, id_stf, error,
+                self.writer)
+            return False
+        return await loop.run_in_executor(None, self._found, id_stf, rows)
+
+    async def _run_async(self, scheduler: IdScheduler) -> None:
+        """Scrap ids given by ``scheduler`` concurrently.
+
+        Leased schedulers claim ranges on the database and wait for other
+        workers, so the scheduler is only called on the loop's default
+        executor.
+        """
+        loop: asyncio.AbstractEventLoop = asyncio.get_running_loop()
+        async with client_session() as session:
+            tasks: Dict[asyncio.Task, int] = {}
+            try:
+                while True:
+                    while len(tasks) < scheduler.max_in_flight:
+                        id_stf: Optional[int] = await loop.run_in_executor(
+                            None, scheduler.next)
+                        if id_stf is None:
+                            break
+                        tasks[asyncio.ensure_future(self._try_search_async(
+                            session, id_stf))] = id_stf
+                    if not tasks:
+                        break
+                    done, _ = await asyncio.wait(
+                        tasks, return_when=asyncio.FIRST_COMPLETED)
+                    for task in done:
+                        await loop.run_in_executor(
+                            None, scheduler.finish, tasks.pop(task),
+                            task.result())
+                    await loop.run_in_executor(
+                        None, self._checkpoint, scheduler)
+            finally:
+                for task in tasks:
+                    task.cancel()
+
+    def _run(self, scheduler: IdScheduler) -> None:
+        """Scrap ids given by ``scheduler`` on a new event loop."""
+        scheduler.max_in_flight = cfg["async"]["max_in_flight"]
+        asyncio.run(self._run_async(scheduler))
+
+
+class AsyncProcessScraper(ProcessScraper):
+    """Scrap detailed processes data on an event loop."""
+
+    async def scrap_process_async(self, session: aiohttp.ClientSession,
+                                  incidente: int) -> None:
+        """Scrap the three tabs of a process concurrently and save them."""
+        logging.info(f"Saving details from {incidente}")
+        urls: dict = self.urls["details"]
+        try:
+            processo_html, partes_html, detalhes_html = await asyncio.gather(
+                async_requester(session,
+                                urls["process"].format(incidente=incidente),
+                                "details"),
+                async_requester(session,
+                                urls["parties"].format(incidente=incidente),
+                                "details"),
+                async_requester(session,
+                                urls["infos"].format(incidente=incidente),
+                                "details"))
+            with metrics.timer("extract_seconds", page="details"):
+                details: ProcessDetails = parse_details(
+                    incidente, processo_html, partes_html, detalhes_html)
+        except CacheMiss as miss:
+            logging.warning(f"Skipping {incidente}, not cached: {miss}")
+            return
+        except Exception as error:
+            logging.exception(f"Failed to scrap {incidente}")
+            await asyncio.get_running_loop().run_in_executor(
+                None, self._fail_process, incidente, error)
+            return
+        metrics.inc("incidents_total")
+        await asyncio.get_running_loop().run_in_executor(
+            None, self._write_details, details)
+
+    async def _run_async(self, incidents: Iterable[int]) -> None:
+        """Scrap all ``incidents`` concurrently."""
+        async with client_session() as session:
+            await run_workers(
+                lambda incidente: self.scrap_process_async(session, incidente),
+                incidents)
+
+    def _run(self, incidents: Iterable[int]) -> None:
+        """Scrap all ``incidents`` on a new event loop."""
+        asyncio.run(self._run_async(incidents))
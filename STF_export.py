@@ -0,0 +1,163 @@
+"""Columnar export of STF data.
+
+``ParquetExporter`` writes ``stf_data`` to Parquet files partitioned by
+protocol year and class, as a hive partitioned dataset read by
+``pyarrow.dataset``, pandas, DuckDB or Spark without touching the database.
+"""
+from datetime import datetime
+from typing import Generator, List, Optional, Tuple
+import itertools
+import json
+import logging
+import os
+import pyarrow as pa
+import pyarrow.parquet as pq
+from STF import cfg
+from db.db_config import config
+from db.db_pool import pooled_connection
+from utils.metrics import metrics
+
+# Columns of ``sql.data.select.export``
+SCHEMA: pa.Schema = pa.schema([
+    ("incidente", pa.int32()),
+    ("numero_unico", pa.string()),
+    ("id_stf", pa.int32()),
+    ("classe_processo_sigla", pa.string()),
+    ("data_protocolo", pa.date32()),
+    ("meio_id", pa.int16()),
+    ("tipo_id", pa.int16()),
+    ("classe_processo", pa.string()),
+    ("partes", pa.list_(pa.string())),
+    ("assuntos", pa.list_(pa.string())),
+    ("orgao_origem", pa.string()),
+    ("origem", pa.string()),
+    ("numeros_origem", pa.list_(pa.string())),
+    ("scrap_date", pa.date32()),
+    ("status", pa.string()),
+    ("updated_at", pa.timestamp("us", tz="UTC")),
+])
+DATA_PROTOCOLO: int = SCHEMA.get_field_index("data_protocolo")
+CLASSE: int = SCHEMA.get_field_index("classe_processo_sigla")
+UPDATED_AT: int = SCHEMA.get_field_index("updated_at")
+
+Partition = Tuple[int, str]
+
+
+def partition(row: tuple) -> Partition:
+    """Return the protocol year and class of a row."""
+    return row[DATA_PROTOCOLO].year, row[CLASSE]
+
+
+def to_table(rows: List[tuple]) -> pa.Table:
+    """Convert rows of ``sql.data.select.export`` to an Arrow table."""
+    columns: List[tuple] = list(zip(*rows))
+    return pa.Table.from_arrays(
+        [pa.array(column, type=field.type)
+         for column, field in zip(columns, SCHEMA)], schema=SCHEMA)
+
+
+class ParquetExporter:
+    """Export ``stf_data`` to Parquet files partitioned by year and class.
+
+    Files are kept on ``path``, under ``year=<protocol year>/classe=<class>``
+    directories. Rows are read by a server-side cursor sorted by partition,
+    so a single file is open at a time and only ``export.chunk_size`` rows
+    are kept in memory, whatever the size of the table.
+
+    Each run adds a file to every partition it touches and keeps the latest
+    ``updated_at`` exported as a watermark, so later runs only export rows
+    changed after it. The watermark is kept ``export.overlap`` seconds
+    behind the start of the run, so rows of writes committed while it reads
+    are not skipped; they may be exported twice instead. A process changed
+    again is found on more than one file: readers must keep its row with the
+    latest ``updated_at``.
+    """
+
+    def __init__(self, path: str = None, db_params: dict = None) -> None:
+        """Initialize state."""
+        self.path: str = path if path is not None else cfg["export"]["path"]
+        self.db_params: dict = db_params if db_params is not None else config()
+        self.watermark_path: str = os.path.join(self.path, "_watermark.json")
+
+    def read_watermark(self) -> Optional[datetime]:
+        """Return the latest ``updated_at`` exported, if any."""
+        if not os.path.exists(self.watermark_path):
+            return None
+        with open(self.watermark_path) as watermark:
+            state: dict = json.load(watermark)
+        # Watermarks of earlier versions held a 'scrap_date'
+        if "updated_at" not in state:
+            return None
+        return datetime.fromisoformat(state["updated_at"])
+
+    def write_watermark(self, updated_at: datetime) -> None:
+        """Keep the latest ``updated_at`` exported."""
+        with open(f"{self.watermark_path}.tmp", "w") as watermark:
+            json.dump({"updated_at": updated_at.isoformat()}, watermark)
+        os.replace(f"{self.watermark_path}.tmp", self.watermark_path)
+
+    def cutoff(self) -> datetime:
+        """Return the latest watermark a run starting now may keep."""
+        with pooled_connection(self.db_params,
+                               cfg["threads"]["max_workers"]) as conn, \
+                conn.cursor() as curs:
+            curs.execute(cfg["sql"]["data"]["select"]["export_cutoff"],
+                         {"overlap": cfg["export"]["overlap"]})
+            return curs.fetchone()[0]
+
+    def retrive_rows(self, since: Optional[datetime]
+                     ) -> Generator[List[tuple], None, None]:
+        """Yield chunks of rows changed after ``since``, by partition.
+
+        All rows are yielded when ``since`` is ``None``.
+        """
+        with pooled_connection(self.db_params,
+                               cfg["threads"]["max_workers"]) as conn, \
+                conn.cursor(name="export_cursor") as curs:
+            curs.itersize = cfg["export"]["chunk_size"]
+            curs.execute(cfg["sql"]["data"]["select"]["export"],
+                         {"since": since})
+            while rows := curs.fetchmany(cfg["export"]["chunk_size"]):
+                yield rows
+
+    def start(self, *, full: bool = False) -> int:
+        """Export rows changed since the watermark and return their count.
+
+        ``full`` exports all rows. Use it on an empty ``path``, as files of
+        earlier runs are kept.
+        """
+        since: Optional[datetime] = None if full else self.read_watermark()
+        # Taken before rows are read, so it precedes their snapshot
+        cutoff: datetime = self.cutoff()
+        logging.info(f"Exporting rows changed since {since} to {self.path}")
+        name: str = f"part-{datetime.now():%Y%m%dT%H%M%S%f}.parquet"
+        current: Optional[Partition] = None
+        writer: Optional[pq.ParquetWriter] = None
+        latest: Optional[datetime] = None
+        count: int = 0
+        try:
+            for rows in self.retrive_rows(since):
+                for key, group in itertools.groupby(rows, partition):
+                    if key != current:
+                        if writer is not None:
+                            writer.close()
+                        current = key
+                        directory: str = os.path.join(
+                            self.path, f"year={key[0]}", f"classe={key[1]}")
+                        os.makedirs(directory, exist_ok=True)
+                        writer = pq.ParquetWriter(
+                            os.path.join(directory, name), SCHEMA)
+                    writer.write_table(to_table(list(group)))
+                newest: datetime = max(row[UPDATED_AT] for row in rows)
+                latest = newest if latest is None else max(latest, newest)
+                count += len(rows)
+                metrics.inc("rows_exported_total", len(rows))
+        finally:
+            if writer is not None:
+                writer.close()
+        if latest is not None:
+            latest = min(latest, cutoff)
+            self.write_watermark(latest if since is None
+                                 else max(since, latest))
+        logging.info(f"Exported {count} rows")
+        return count
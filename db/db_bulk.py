@@ -0,0 +1,60 @@
+"""Bulk database writes through COPY and staging tables."""
+from datetime import date
+from typing import Dict, Optional
+import io
+import json
+from psycopg2.extensions import cursor
+from db.db_testing import DBTester
+from db.db_writer import BatchWriter
+
+
+def copy_value(value) -> str:
+    """Render a value on the text format of ``COPY``.
+
+    Lists and tuples are rendered as JSON, which merges turn into arrays.
+    """
+    if value is None:
+        return "\\N"
+    if isinstance(value, (list, tuple)):
+        value = json.dumps(value, ensure_ascii=False)
+    elif isinstance(value, date):
+        value = value.isoformat()
+    else:
+        value = str(value)
+    return value.replace("\\", "\\\\").replace("\t", "\\t") \
+        .replace("\n", "\\n").replace("\r", "\\r")
+
+
+class BulkWriter(BatchWriter):
+    """Batch writer that loads rows with ``COPY`` and merges them.
+
+    ``stages`` maps statements given to ``add`` to their staging tables, each
+    with ``table``, ``create``, ``copy`` and ``merge`` statements. Rows are
+    streamed into the unlogged staging table by ``COPY FROM STDIN`` and moved
+    to their tables by a single set based ``merge``, on the transaction of
+    the flush. Staging tables are only ever seen empty by other transactions,
+    so they can be shared by any number of workers.
+
+    Other statements are written as by ``BatchWriter``. ``on_returning``
+    callbacks receive the rows returned by the merge.
+    """
+
+    def __init__(self, stages: Dict[str, dict], db_params: dict = None,
+                 batch_size: int = 20000, maxconn: int = 8) -> None:
+        """Initialize buffers and test staging tables."""
+        super().__init__(db_params, batch_size, maxconn)
+        self.stages: Dict[str, dict] = stages
+        for stage in stages.values():
+            DBTester(stage["table"], stage["create"], db_params)
+
+    def _write(self, curs: cursor, sql: str, template: Optional[str],
+               rows: list, fetch: bool) -> Optional[list]:
+        """Copy the rows of a staged statement and merge them."""
+        stage: Optional[dict] = self.stages.get(sql)
+        if stage is None:
+            return super()._write(curs, sql, template, rows, fetch)
+        curs.copy_expert(stage["copy"], io.StringIO("".join(
+            "\t".join(copy_value(value) for value in row) + "\n"
+            for row in rows)))
+        curs.execute(stage["merge"])
+        return curs.fetchall() if fetch else None
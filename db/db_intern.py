@@ -0,0 +1,67 @@
+"""Ids of repeated values kept on dimension tables."""
+from collections import OrderedDict
+from typing import Dict, List, Sequence
+import threading
+from db.db_config import config
+from db.db_pool import pooled_connection
+from db.db_testing import DBTester
+from utils.metrics import metrics
+
+
+class Interner:
+    """Resolve values of a dimension table to their ids.
+
+    Ids are kept on a least recently used cache of ``maxsize`` values, so
+    names repeated across processes are resolved without reaching the
+    database. Values missing from the cache are found or inserted together,
+    on a single round trip.
+
+    ``sql`` is an entry of ``sql.dimensions`` on the configuration file.
+    """
+
+    def __init__(self, sql: dict, db_params: dict = None,
+                 maxsize: int = 100000, maxconn: int = 8) -> None:
+        """Initialize the cache and test the dimension table."""
+        self.sql: dict = sql
+        self.db_params: dict = db_params if db_params is not None else config()
+        self.maxsize: int = maxsize
+        self.maxconn: int = maxconn
+        self._cache: "OrderedDict[str, int]" = OrderedDict()
+        self._lock = threading.Lock()
+        DBTester(sql["table"], sql["create"], self.db_params)
+
+    def ids(self, values: Sequence[str]) -> List[int]:
+        """Return the id of each value, adding new values to the table."""
+        found: Dict[str, int] = {}
+        with self._lock:
+            for value in values:
+                if value in self._cache:
+                    self._cache.move_to_end(value)
+                    found[value] = self._cache[value]
+        missing: List[str] = list({value: None for value in values
+                                   if value not in found})
+        metrics.inc("intern_hits_total", len(values) - len(missing),
+                    table=self.sql["table"])
+        if missing:
+            metrics.inc("intern_misses_total", len(missing),
+                        table=self.sql["table"])
+            resolved: Dict[str, int] = self._resolve(missing)
+            found.update(resolved)
+            with self._lock:
+                self._cache.update(resolved)
+                while len(self._cache) > self.maxsize:
+                    self._cache.popitem(last=False)
+        return [found[value] for value in values]
+
+    def _resolve(self, values: List[str]) -> Dict[str, int]:
+        """Find or insert ``values`` on the dimension table."""
+        resolved: Dict[str, int] = {}
+        with pooled_connection(self.db_params, self.maxconn) as conn, \
+                conn.cursor() as curs:
+            while len(resolved) < len(values):
+                # Values inserted by other workers after the query started
+                # are neither found nor inserted, and are asked for again
+                curs.execute(self.sql["intern"], {"values": [
+                    value for value in values if value not in resolved]})
+                resolved.update((value, id_) for id_, value in curs)
+        return resolved
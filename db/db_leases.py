@@ -0,0 +1,102 @@
+"""Leases that split scraping work between many workers."""
+from typing import List, Optional, Tuple
+import os
+import socket
+from db.db_config import config
+from db.db_pool import pooled_connection
+from db.db_testing import DBTester
+
+
+class LeaseManager:
+    """Hand out search id ranges and incidents to workers through Postgres.
+
+    Work is claimed with ``SELECT ... FOR UPDATE SKIP LOCKED``, so workers on
+    any machine sharing the database never get the same range or incident
+    while a lease is valid. Leases expire after ``expiry`` seconds and are
+    taken by other workers, so the work of a crashed worker is not lost.
+
+    ``sql`` is the ``sql.leases`` section of the configuration file.
+    """
+
+    def __init__(self, sql: dict, db_params: dict = None, owner: str = None,
+                 expiry: float = 600, maxconn: int = 8) -> None:
+        """Initialize state and test lease tables.
+
+        ``owner`` identifies the worker on lease tables and defaults to the
+        host name and process id.
+        """
+        self.sql: dict = sql
+        self.db_params: dict = db_params if db_params is not None else config()
+        self.owner: str = owner if owner is not None \
+            else f"{socket.gethostname()}:{os.getpid()}"
+        self.expiry: float = expiry
+        self.maxconn: int = maxconn
+        DBTester("stf_id_leases", sql["ids"]["create"], self.db_params)
+        DBTester("stf_incident_leases", sql["incidents"]["create"],
+                 self.db_params)
+
+    def _params(self, **params) -> dict:
+        """Add the owner and expiry to query parameters."""
+        return {"owner": self.owner, "expiry": self.expiry, **params}
+
+    def reset(self, scope: str) -> None:
+        """Forget finished ranges of ``scope`` if no range is being scraped.
+
+        A new run can then start from the last id found instead of past the
+        ids scraped by the previous one.
+        """
+        with pooled_connection(self.db_params, self.maxconn) as conn, \
+                conn.cursor() as curs:
+            curs.execute(self.sql["ids"]["reset"], {"scope": scope})
+
+    def claim_range(self, scope: str, start: int, size: int,
+                    max_misses: int) -> Optional[Tuple[int, int]]:
+        """Lease a range of ``size`` ids of ``scope`` as ``(start, end)``.
+
+        Expired ranges are taken first. New ranges follow the last range
+        leased, beginning at ``start``, as long as they begin within
+        ``max_misses`` ids past the last hit of finished ranges. ``None`` is
+        returned when no range can be leased now.
+        """
+        with pooled_connection(self.db_params, self.maxconn) as conn, \
+                conn.cursor() as curs:
+            params: dict = self._params(scope=scope, start=start, size=size)
+            curs.execute(self.sql["ids"]["reclaim"], params)
+            claimed: Optional[Tuple[int, int]] = curs.fetchone()
+            while claimed is None:
+                curs.execute(self.sql["ids"]["frontier"], params)
+                range_start, last_hit = curs.fetchone()
+                if range_start > last_hit + max_misses:
+                    return None
+                curs.execute(self.sql["ids"]["claim"],
+                             {**params, "range_start": range_start})
+                # Empty when another worker leased the same range first
+                claimed = curs.fetchone()
+            return claimed
+
+    def complete_range(self, scope: str, range_start: int,
+                       last_hit: Optional[int]) -> None:
+        """Mark a range as scraped, with its highest id with processes."""
+        with pooled_connection(self.db_params, self.maxconn) as conn, \
+                conn.cursor() as curs:
+            curs.execute(self.sql["ids"]["complete"], {
+                "scope": scope, "range_start": range_start,
+                "last_hit": last_hit})
+
+    def active(self, scope: str) -> bool:
+        """Tell if any range of ``scope`` is leased and not finished."""
+        with pooled_connection(self.db_params, self.maxconn) as conn, \
+                conn.cursor() as curs:
+            curs.execute(self.sql["ids"]["active"], {"scope": scope})
+            return curs.fetchone()[0]
+
+    def claim_incidents(self, batch_size: int) -> List[int]:
+        """Lease up to ``batch_size`` incomplete incidents.
+
+        Leases of incidents that are no longer pending are dropped first.
+        """
+        with pooled_connection(self.db_params, self.maxconn) as conn, \
+                conn.cursor() as curs:
+            curs.execute(self.sql["incidents"]["claim"],
+                         self._params(batch_size=batch_size))
+            return [row[0] for row in curs.fetchall()]
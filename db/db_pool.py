@@ -0,0 +1,73 @@
+"""Shared database connection pools."""
+from contextlib import contextmanager
+from typing import Dict, Generator, Tuple
+import threading
+from psycopg2.extensions import connection
+from psycopg2.pool import ThreadedConnectionPool
+from db_config import config
+
+_pools: Dict[Tuple, "BlockingPool"] = {}
+_pools_lock = threading.Lock()
+
+
+class BlockingPool(ThreadedConnectionPool):
+    """Thread safe pool that waits for a free connection when exhausted.
+
+    ``ThreadedConnectionPool`` raises ``PoolError`` when all connections are
+    in use, which would happen whenever there are more workers than
+    connections.
+    """
+
+    def __init__(self, maxconn: int, **db_params) -> None:
+        """Open the first connection and limit checkouts to ``maxconn``."""
+        super().__init__(1, maxconn, **db_params)
+        self._slots = threading.BoundedSemaphore(maxconn)
+
+    def getconn(self, key=None) -> connection:
+        """Wait for a free slot and return a connection."""
+        self._slots.acquire()
+        try:
+            return super().getconn(key)
+        except Exception:
+            self._slots.release()
+            raise
+
+    def putconn(self, conn=None, key=None, close=False) -> None:
+        """Return a connection and free its slot."""
+        try:
+            super().putconn(conn, key, close)
+        finally:
+            self._slots.release()
+
+
+def get_pool(db_params: dict = None, maxconn: int = 8) -> BlockingPool:
+    """Return the pool shared by all users of ``db_params``.
+
+    ``maxconn`` is only used when the pool is created.
+    """
+    db_params = db_params if db_params is not None else config()
+    key: Tuple = tuple(sorted(db_params.items()))
+    with _pools_lock:
+        if key not in _pools:
+            _pools[key] = BlockingPool(maxconn, **db_params)
+        return _pools[key]
+
+
+@contextmanager
+def pooled_connection(db_params: dict = None, maxconn: int = 8
+                      ) -> Generator[connection, None, None]:
+    """Borrow a connection, committing on success and rolling back on error.
+
+    Broken connections are discarded instead of going back to the pool.
+    """
+    pool: BlockingPool = get_pool(db_params, maxconn)
+    conn: connection = pool.getconn()
+    try:
+        yield conn
+        conn.commit()
+    except Exception:
+        if not conn.closed:
+            conn.rollback()
+        raise
+    finally:
+        pool.putconn(conn, close=bool(conn.closed))
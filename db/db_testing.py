@@ -1,13 +1,18 @@
 """Tools to test databases and tables."""
 import psycopg2 as pg
+from psycopg2.extensions import cursor
 from db_config import config
 
+# Key of the advisory lock held while creating or migrating tables
+DDL_LOCK: int = 7263001
+
 
 class DBTester:
     """Test database connection, create table if it does not exist."""
 
     def __init__(self, table_name: str, sql: str, db_params: dict = None):
         """Initialize db params and run methods as needed."""
+        self.table_name = table_name
         self.db_params = db_params if db_params is not None else config()
         self.test_db_connection()
         if not self.test_table(table_name):
@@ -29,10 +34,48 @@ class DBTester:
             table_exists: int = curs.fetchone()[0]
         return True if table_exists else False
 
-    def create_table(self, sql: str) -> None:
-        """Create a table with a given SQL."""
+    def test_column(self, column: str) -> bool:
+        """Test if the table has a column."""
+        with pg.connect(**self.db_params) as conn, conn.cursor() as curs:
+            curs.execute("""
+            SELECT COUNT(*)
+                FROM information_schema.columns
+                WHERE table_name = %s AND column_name = %s
+            """, (self.table_name, column))
+            return bool(curs.fetchone()[0])
+
+    def migrate(self, column: str, sql: str) -> None:
+        """Run a migration with a given SQL if the table lacks a column."""
+        if not self.test_column(column):
+            self.create_table(sql, column)
+
+    def create_table(self, sql: str, column: str = None) -> None:
+        """Create a table, or add ``column`` to it, with a given SQL.
+
+        Workers starting together are serialized by an advisory lock, and
+        the table or column is tested again once it is held, so only the
+        first one runs the SQL.
+        """
         with pg.connect(**self.db_params) as conn, conn.cursor() as curs:
-            curs.execute(sql)
+            curs.execute("SELECT pg_advisory_xact_lock(%s)", (DDL_LOCK,))
+            if not self._exists(curs, column):
+                curs.execute(sql)
             conn.commit()
             curs.execute("SET datestyle = dmy;")
             conn.commit()
+
+    def _exists(self, curs: cursor, column: str = None) -> bool:
+        """Test if the table, or its ``column``, exists."""
+        if column is None:
+            curs.execute("""
+            SELECT COUNT(*)
+                FROM information_schema.tables
+                WHERE table_name = %s
+            """, (self.table_name,))
+        else:
+            curs.execute("""
+            SELECT COUNT(*)
+                FROM information_schema.columns
+                WHERE table_name = %s AND column_name = %s
+            """, (self.table_name, column))
+        return bool(curs.fetchone()[0])
@@ -0,0 +1,135 @@
+"""Batched database writes shared by many worker threads."""
+from typing import Callable, Dict, Hashable, List, Optional, Set, Tuple
+import threading
+from psycopg2.extensions import cursor
+from psycopg2.extras import execute_values
+from db.db_pool import pooled_connection
+from utils.metrics import metrics
+
+
+class BatchWriter:
+    """Buffer rows of many statements and write them in batches.
+
+    Each statement must have a single ``VALUES %s`` placeholder, which is
+    filled by ``execute_values``. All buffered statements are written and
+    committed together once ``batch_size`` rows are buffered or ``flush`` is
+    called.
+
+    Rows added with a ``key`` are collapsed: only the greatest row of each key
+    is kept, which turns many upserts of the same row into one. Rows added
+    with ``latest`` keep the last row of each key instead, for statements
+    that replace what is stored.
+
+    Rows returned by statements with a ``RETURNING`` clause can be handed to
+    a callback set by ``on_returning`` once they are committed.
+
+    Rows of a batch that fails to be written are buffered again, ahead of
+    rows added since, and the error is raised. No later batch is committed
+    without them.
+    """
+
+    def __init__(self, db_params: dict = None, batch_size: int = 500,
+                 maxconn: int = 8) -> None:
+        """Initialize buffers."""
+        self.db_params: Optional[dict] = db_params
+        self.batch_size: int = batch_size
+        self.maxconn: int = maxconn
+        self._rows: Dict[Tuple[str, Optional[str]], list] = {}
+        self._keyed: Dict[Tuple[str, Optional[str]], Dict[Hashable, tuple]] \
+            = {}
+        self._size: int = 0
+        self._latest: Set[Tuple[str, Optional[str]]] = set()
+        self._callbacks: Dict[str, Callable[[list], None]] = {}
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+
+    def add(self, sql: str, row: tuple, key: Hashable = None,
+            template: str = None, latest: bool = False) -> None:
+        """Buffer ``row`` for ``sql`` and write a batch if it is full.
+
+        ``template`` is passed to ``execute_values`` and allows casting values
+        of each row. ``latest`` keeps the last row added of ``key`` rather
+        than the greatest.
+        """
+        with self._lock:
+            statement: Tuple[str, Optional[str]] = (sql, template)
+            if key is None:
+                self._rows.setdefault(statement, []).append(row)
+                self._size += 1
+            else:
+                if latest:
+                    self._latest.add(statement)
+                keyed: Dict[Hashable, tuple] = self._keyed.setdefault(
+                    statement, {})
+                if key not in keyed:
+                    self._size += 1
+                    keyed[key] = row
+                elif latest or row > keyed[key]:
+                    keyed[key] = row
+            full: bool = self._size >= self.batch_size
+        if full:
+            self.flush()
+
+    def on_returning(self, sql: str, callback: Callable[[list], None]
+                     ) -> None:
+        """Pass rows returned by ``sql`` to ``callback`` after each flush.
+
+        Callbacks run in the order of flushes, before the next one starts.
+        """
+        self._callbacks[sql] = callback
+
+    def _write(self, curs: cursor, sql: str, template: Optional[str],
+               rows: list, fetch: bool) -> Optional[list]:
+        """Write the rows of a statement, returning rows if ``fetch``."""
+        return execute_values(curs, sql, rows, template=template,
+                              page_size=len(rows), fetch=fetch)
+
+    def _restore(self, rows: Dict[Tuple[str, Optional[str]], list],
+                 keyed: Dict[Tuple[str, Optional[str]],
+                             Dict[Hashable, tuple]]) -> None:
+        """Buffer again the rows of a failed batch, ahead of newer rows."""
+        for statement, batch in rows.items():
+            self._rows[statement] = batch + self._rows.get(statement, [])
+        for statement, batch in keyed.items():
+            newer: Dict[Hashable, tuple] = self._keyed.get(statement, {})
+            for key, row in newer.items():
+                if key not in batch or statement in self._latest \
+                        or row > batch[key]:
+                    batch[key] = row
+            self._keyed[statement] = batch
+        self._size = sum(map(len, self._rows.values())) \
+            + sum(map(len, self._keyed.values()))
+
+    def flush(self) -> None:
+        """Write all buffered rows in a single transaction."""
+        # Writes are serialized so batches reach the database in order
+        with self._flush_lock:
+            with self._lock:
+                rows, keyed = self._rows, self._keyed
+                self._rows, self._keyed, self._size = {}, {}, 0
+            batches: List[Tuple[Tuple[str, Optional[str]], list]] = [
+                (statement, batch) for statement, batch in rows.items()]
+            batches += [(statement, list(batch.values()))
+                        for statement, batch in keyed.items()]
+            if not any(batch for _, batch in batches):
+                return
+            returned: List[Tuple[str, list]] = []
+            try:
+                with metrics.timer("db_write_seconds"), \
+                        pooled_connection(self.db_params,
+                                          self.maxconn) as conn, \
+                        conn.cursor() as curs:
+                    for (sql, template), batch in batches:
+                        fetch: bool = sql in self._callbacks
+                        result: Optional[list] = self._write(
+                            curs, sql, template, batch, fetch)
+                        if fetch:
+                            returned.append((sql, result))
+            except Exception:
+                with self._lock:
+                    self._restore(rows, keyed)
+                raise
+            metrics.inc("db_rows_total",
+                        sum(len(batch) for _, batch in batches))
+            for sql, result in returned:
+                self._callbacks[sql](result)
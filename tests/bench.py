@@ -0,0 +1,240 @@
+"""End-to-end scraper benchmarks against the local mock portal.
+
+Runs ``SearchScraper.start`` and then ``ProcessScraper.start`` once per
+``max_workers`` setting, each on a fresh process, and reports ids and
+incidents per second, request latencies and peak memory. Run from the
+repository root::
+
+    python3 tests/bench.py --workers 8 16 32 --last-id 500 --latency 0.05
+
+Rows are kept in memory by default. Use ``--sink postgres`` to write them to
+the testing database instead, which is dropped before each run, or ``--sink
+bulk`` to write them by ``COPY`` through staging tables.
+"""
+from concurrent.futures import ThreadPoolExecutor
+from datetime import date, datetime
+from typing import Dict, Generator, Hashable, List, Optional, Tuple
+import argparse
+import json
+import logging
+import multiprocessing
+import os
+import resource
+import sys
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(
+    __file__))))
+
+import psycopg2 as pg  # noqa: E402
+from mock_portal import MockPortal  # noqa: E402
+from utils import funcs  # noqa: E402
+from utils.metrics import metrics  # noqa: E402
+import STF  # noqa: E402
+
+
+class MemoryWriter:
+    """Keep rows in memory, with the interface of ``BatchWriter``."""
+
+    def __init__(self) -> None:
+        """Initialize empty buffers."""
+        self.rows: Dict[str, list] = {}
+        self._lock = threading.Lock()
+
+    def add(self, sql: str, row: tuple, key: Hashable = None,
+            template: str = None, latest: bool = False) -> None:
+        """Keep ``row`` under its statement."""
+        with self._lock:
+            self.rows.setdefault(sql, []).append(row)
+
+    def flush(self) -> None:
+        """Nothing to write."""
+
+
+class MemorySearchScraper(STF.SearchScraper):
+    """Search scraper that keeps rows in a ``MemoryWriter``."""
+
+    def __init__(self) -> None:
+        """Initialize state without touching the database."""
+        self.db_params: Optional[dict] = None
+        self.code: Optional[str] = None
+        self.step: Optional[int] = None
+        self.urls: dict = STF.cfg["urls"]
+        self.now: date = datetime.now().date()
+        self.writer: MemoryWriter = MemoryWriter()
+        self.stopping: threading.Event = threading.Event()
+
+    def calc_start(self, mode: str) -> int:
+        """Return the highest id found, as ``max`` mode does."""
+        found: List[tuple] = self.writer.rows.get(
+            STF.cfg["sql"]["scrap_log"]["insert_batch"], [])
+        return max((row[1] for row in found), default=1)
+
+    def _resume(self) -> Optional[Tuple[int, Optional[int]]]:
+        """Runs are not resumed."""
+        return None
+
+    def _retry_holes(self) -> None:
+        """Failed ids are not retried."""
+
+    def _complete(self) -> None:
+        """Nothing to mark as done."""
+
+    def incidents(self) -> List[int]:
+        """Return all incidents found."""
+        return [row[0] for row in self.writer.rows.get(
+            STF.cfg["sql"]["data"]["insert_batch"], [])]
+
+
+class MemoryProcessScraper(STF.ProcessScraper):
+    """Process scraper that reads incidents from a list and keeps rows."""
+
+    def __init__(self, incidents: List[int]) -> None:
+        """Initialize state without touching the database."""
+        self.scrap_date: date = datetime.now().date()
+        self.urls: dict = STF.cfg["urls"]
+        self.db_params: Optional[dict] = None
+        self.writer: MemoryWriter = MemoryWriter()
+        self.tab_pool: ThreadPoolExecutor = STF.get_tab_pool()
+        self._incidents: List[int] = incidents
+
+    def _write_relations(self, incidente: int, **relations) -> None:
+        """Nothing to intern without a database."""
+
+    def _resolve_failures(self) -> None:
+        """Nothing was journaled."""
+
+    def retrive_incidents(self, select: str = "incomplete"
+                          ) -> Generator[Tuple[int], None, None]:
+        """Yield the given incidents."""
+        for incidente in self._incidents:
+            yield (incidente,)
+
+
+def latency(endpoint: str) -> Tuple[float, float]:
+    """Return p50 and p99 request latencies of an endpoint, in ms."""
+    histogram = metrics.histograms.get(
+        ("http_request_seconds", (("endpoint", endpoint),)))
+    if histogram is None:
+        return 0.0, 0.0
+    return histogram.quantile(0.5) * 1000, histogram.quantile(0.99) * 1000
+
+
+def run(urls: dict, workers: int, sink: str, max_misses: int,
+        governed: bool, verbose: bool) -> dict:
+    """Run both scrapers with ``workers`` threads and return measures.
+
+    Settings are changed on this process only, so it should be a fresh one.
+    """
+    if not verbose:
+        # Logging each id is slow on a terminal
+        logging.getLogger().setLevel(logging.WARNING)
+    for config in (STF.cfg, funcs.cfg):
+        config["threads"]["max_workers"] = workers
+        config["scheduler"]["max_misses"] = max_misses
+        if not governed:
+            # Measure the scrapers, not the portal's rate limits
+            for governor in config["governor"].values():
+                governor.update(rate=1e6, burst=1e6, max_concurrency=1e6)
+    db_params: dict = STF.cfg["testing"]["db_params"]
+    STF.cfg["database"]["bulk"] = sink == "bulk"
+    if sink != "memory":
+        with pg.connect(**db_params) as conn, conn.cursor() as curs:
+            curs.execute(STF.cfg["testing"]["sql"]["drop_all"])
+            conn.commit()
+        search_scraper: STF.SearchScraper = STF.SearchScraper(db_params)
+    else:
+        search_scraper = MemorySearchScraper()
+    search_scraper.urls = urls
+
+    metrics.reset()
+    started: float = time.perf_counter()
+    search_scraper.start(mode="max")
+    search_time: float = time.perf_counter() - started
+    ids: float = metrics.counters.get(("ids_total", ()), 0)
+    search_p50, search_p99 = latency("search")
+
+    if sink != "memory":
+        process_scraper: STF.ProcessScraper = STF.ProcessScraper(db_params)
+    else:
+        process_scraper = MemoryProcessScraper(search_scraper.incidents())
+    process_scraper.urls = urls
+
+    metrics.reset()
+    started = time.perf_counter()
+    process_scraper.start()
+    process_time: float = time.perf_counter() - started
+    incidents: float = metrics.counters.get(("incidents_total", ()), 0)
+    details_p50, details_p99 = latency("details")
+
+    return {
+        "workers": workers, "sink": sink,
+        "ids": ids, "ids_per_s": ids / search_time,
+        "incidents": incidents, "incidents_per_s": incidents / process_time,
+        "search_p50_ms": search_p50, "search_p99_ms": search_p99,
+        "details_p50_ms": details_p50, "details_p99_ms": details_p99,
+        # Kilobytes on Linux
+        "peak_rss_mb": resource.getrusage(
+            resource.RUSAGE_SELF).ru_maxrss / 1024}
+
+
+def bench(portal: MockPortal, workers: List[int], sink: str = "memory",
+          max_misses: int = 50, governed: bool = False,
+          verbose: bool = False) -> List[dict]:
+    """Run ``run`` on a fresh process for each ``workers`` setting."""
+    context = multiprocessing.get_context("spawn")
+    results: List[dict] = []
+    for count in workers:
+        with context.Pool(1) as pool:
+            results.append(pool.apply(
+                run, (portal.urls, count, sink, max_misses, governed,
+                      verbose)))
+    return results
+
+
+def main() -> None:
+    """Parse arguments, run benchmarks and print a table."""
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--workers", type=int, nargs="+", default=[8, 24])
+    parser.add_argument("--sink", choices=["memory", "postgres", "bulk"],
+                        default="memory")
+    parser.add_argument("--last-id", type=int, default=300,
+                        help="last search id with processes")
+    parser.add_argument("--density", type=float, default=0.5,
+                        help="share of ids with processes")
+    parser.add_argument("--latency", type=float, default=0.05,
+                        help="seconds waited by the portal per response")
+    parser.add_argument("--error-rate", type=float, default=0.0,
+                        help="share of responses answered with a 503")
+    parser.add_argument("--max-misses", type=int, default=50)
+    parser.add_argument("--governed", action="store_true",
+                        help="keep the governor limits of the config file")
+    parser.add_argument("--verbose", action="store_true",
+                        help="log each id and incident scraped")
+    parser.add_argument("--json", help="also write results to this file")
+    args = parser.parse_args()
+
+    with MockPortal(args.last_id, args.density, args.latency,
+                    args.error_rate) as portal:
+        results: List[dict] = bench(portal, args.workers, args.sink,
+                                    args.max_misses, args.governed,
+                                    args.verbose)
+
+    print(f"{'workers':>7} {'ids/s':>8} {'inc/s':>8} {'search ms':>15} "
+          f"{'details ms':>15} {'RSS MB':>7}")
+    for result in results:
+        print(f"{result['workers']:>7} {result['ids_per_s']:>8.1f} "
+              f"{result['incidents_per_s']:>8.1f} "
+              f"{result['search_p50_ms']:>7.1f}/"
+              f"{result['search_p99_ms']:<7.1f} "
+              f"{result['details_p50_ms']:>7.1f}/"
+              f"{result['details_p99_ms']:<7.1f} "
+              f"{result['peak_rss_mb']:>7.1f}")
+    if args.json:
+        with open(args.json, "w") as output:
+            json.dump(results, output, indent=2)
+
+
+if __name__ == "__main__":
+    main()
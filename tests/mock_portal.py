@@ -0,0 +1,182 @@
+"""Local stand-in for the STF portal.
+
+Serves the pages saved in ``tests/fixtures`` so scrapers can be tested and
+benchmarked without reaching ``portal.stf.jus.br``.
+"""
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Dict, Optional, Tuple
+from urllib.parse import parse_qs, urlparse
+import gzip
+import hashlib
+import os
+import random
+import re
+import threading
+import time
+
+FIXTURES_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                            "fixtures")
+ROW_RE = re.compile(r"\s*<tr>\s*<td>.*?</tr>", re.DOTALL)
+LINK_RE = re.compile(r'incidente=\d+">(\S+) \d+<')
+
+
+def load_fixture(name: str) -> bytes:
+    """Read a saved page from the fixtures directory."""
+    with open(os.path.join(FIXTURES_DIR, name), "rb") as fixture:
+        return fixture.read()
+
+
+class MockPortal:
+    """Serve search and details pages from fixtures on a local port.
+
+    Ids from ``1`` to ``last_id`` list the processes of the search fixture,
+    each one with its own ``incidente``, with probability ``density``. Other
+    ids list no processes and non numeric ids return an empty page, as the
+    real portal does.
+
+    ``latency`` seconds are waited before each response and ``error_rate``
+    is the probability of answering with a ``503``. Pages carry an ``ETag``
+    and conditional requests of unchanged pages are answered with a ``304``.
+    """
+
+    def __init__(self, last_id: int = 2, density: float = 1.0,
+                 latency: float = 0.0, error_rate: float = 0.0,
+                 seed: int = 0) -> None:
+        """Load fixtures and set the portal behaviour."""
+        self.last_id: int = last_id
+        self.density: float = density
+        self.latency: float = latency
+        self.error_rate: float = error_rate
+        self.seed: int = seed
+        self.hits: Dict[str, int] = {}
+        # Requests of each search page, by class and number
+        self.searches: Dict[Tuple[str, str], int] = {}
+        # Conditional requests answered with a '304'
+        self.not_modified: int = 0
+        self._lock = threading.Lock()
+        self._random = random.Random(seed)
+        search: str = load_fixture("listarProcessos.html").decode("utf-8")
+        self._rows = ROW_RE.findall(search)
+        self._search_head: str = search[:search.index(self._rows[0])]
+        self._search_tail: str = search[
+            search.index(self._rows[-1]) + len(self._rows[-1]):]
+        self._details: Dict[str, bytes] = {
+            page: load_fixture(f"{page}.html")
+            for page in ("detalhe", "abaPartes", "abaInformacoes")}
+        self._server: Optional[ThreadingHTTPServer] = None
+
+    @property
+    def urls(self) -> dict:
+        """Return URLs in the same shape as ``cfg["urls"]``."""
+        host, port = self._server.server_address
+        base: str = f"http://{host}:{port}/processos/"
+        return {
+            "search": base
+                + "listarProcessos.asp?classe={classe}&numeroProcesso={num}",
+            "details": {
+                "process": base + "detalhe.asp?incidente={incidente}",
+                "parties": base + "abaPartes.asp?incidente={incidente}",
+                "infos": base + "abaInformacoes.asp?incidente={incidente}"}}
+
+    def has_processes(self, id_stf: int) -> bool:
+        """Tell whether ``id_stf`` lists any process."""
+        if not 1 <= id_stf <= self.last_id:
+            return False
+        return random.Random(self.seed + id_stf).random() < self.density
+
+    def search_page(self, num: str, classe: str = "") -> bytes:
+        """Render the search page of process number ``num``."""
+        if not num.isdigit():
+            return b""
+        id_stf: int = int(num)
+        rows: str = ""
+        if self.has_processes(id_stf):
+            for position, row in enumerate(self._rows):
+                sigla: str = LINK_RE.search(row).group(1)
+                if classe and sigla != classe:
+                    continue
+                rows += LINK_RE.sub(
+                    f'incidente={id_stf * 10 + position}">{sigla} {id_stf}<',
+                    row)
+        return (self._search_head + rows + self._search_tail).encode("utf-8")
+
+    def respond(self, path: str, query: dict) -> Optional[bytes]:
+        """Return the body for a request or ``None`` if it is unknown."""
+        page: str = path.rsplit("/", 1)[-1].replace(".asp", "")
+        with self._lock:
+            self.hits[page] = self.hits.get(page, 0) + 1
+        if page == "listarProcessos":
+            num: str = query.get("numeroProcesso", [""])[0]
+            classe: str = query.get("classe", [""])[0]
+            with self._lock:
+                self.searches[classe, num] = \
+                    self.searches.get((classe, num), 0) + 1
+            return self.search_page(num, classe)
+        return self._details.get(page)
+
+    def should_fail(self) -> bool:
+        """Draw an injected error."""
+        with self._lock:
+            return self._random.random() < self.error_rate
+
+    def start(self) -> "MockPortal":
+        """Serve on a free local port in a background thread."""
+        portal = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+            # Headers and body are written apart, which Nagle's algorithm
+            # would delay on keep-alive connections
+            disable_nagle_algorithm = True
+
+            def do_GET(self) -> None:
+                if portal.latency:
+                    time.sleep(portal.latency)
+                url = urlparse(self.path)
+                body: Optional[bytes] = portal.respond(
+                    url.path, parse_qs(url.query))
+                status: int = 200
+                if body is None:
+                    status, body = 404, b""
+                elif portal.should_fail():
+                    status, body = 503, b""
+                etag: str = f'"{hashlib.sha1(body).hexdigest()}"'
+                if status == 200 \
+                        and self.headers.get("If-None-Match") == etag:
+                    with portal._lock:
+                        portal.not_modified += 1
+                    self.send_response(304)
+                    self.send_header("ETag", etag)
+                    self.end_headers()
+                    return
+                self.send_response(status)
+                # No charset, like the real portal
+                self.send_header("Content-Type", "text/html")
+                if status == 200:
+                    self.send_header("ETag", etag)
+                if "gzip" in self.headers.get("Accept-Encoding", ""):
+                    body = gzip.compress(body)
+                    self.send_header("Content-Encoding", "gzip")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args) -> None:
+                pass
+
+        self._server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self._server.daemon_threads = True
+        threading.Thread(target=self._server.serve_forever,
+                         daemon=True).start()
+        return self
+
+    def stop(self) -> None:
+        """Shut the server down."""
+        self._server.shutdown()
+        self._server.server_close()
+
+    def __enter__(self) -> "MockPortal":
+        return self.start()
+
+    def __exit__(self, *exc) -> None:
+        self.stop()
@@ -0,0 +1,75 @@
+"""Parser micro-benchmarks on saved STF pages.
+
+Run ``python3 -m pytest tests/test_benchmarks.py`` and read the ``OPS``
+column as parsed pages per second. Use ``--benchmark-autosave`` and
+``--benchmark-compare`` to track regressions between runs.
+
+End-to-end scraper benchmarks are run by ``tests/bench.py``.
+"""
+import pytest
+
+from bench import bench
+from mock_portal import load_fixture, MockPortal
+from utils.funcs import parse_html
+from utils.parsers import (parse_details, parse_incident, parse_parts,
+                           parse_process, parse_search)
+
+PAGES = {name: load_fixture(f"{name}.html")
+         for name in ("detalhe", "abaPartes", "abaInformacoes")}
+PAGES["listarProcessos"] = MockPortal().search_page("1")
+
+
+@pytest.mark.parametrize("name", sorted(PAGES))
+def test_parse_html(benchmark, name):
+    """Decoding and lxml tree building of each page."""
+    benchmark(parse_html, PAGES[name])
+
+
+def test_parse_search(benchmark):
+    """Search page rows."""
+    search_html = parse_html(PAGES["listarProcessos"])
+    assert len(benchmark(parse_search, search_html)) == 4
+
+
+def test_parse_search_code(benchmark):
+    """Search page rows filtered by class."""
+    search_html = parse_html(PAGES["listarProcessos"])
+    assert len(benchmark(parse_search, search_html, "HC")) == 1
+
+
+def test_parse_process(benchmark):
+    """'process' tab."""
+    processo_html = parse_html(PAGES["detalhe"])
+    assert benchmark(parse_process, processo_html)
+
+
+def test_parse_parts(benchmark):
+    """'parts' tab."""
+    partes_html = parse_html(PAGES["abaPartes"])
+    assert len(benchmark(parse_parts, partes_html)) == 4
+
+
+def test_parse_incident(benchmark):
+    """'incident' tab."""
+    detalhes_html = parse_html(PAGES["abaInformacoes"])
+    assert benchmark(parse_incident, detalhes_html)["origem"]
+
+
+def test_parse_details(benchmark):
+    """All tabs of a process, from raw pages to a record."""
+    def parse_all():
+        return parse_details(1, parse_html(PAGES["detalhe"]),
+                             parse_html(PAGES["abaPartes"]),
+                             parse_html(PAGES["abaInformacoes"]))
+    assert benchmark(parse_all).numeros_origem == ("1234", "5678")
+
+
+def test_end_to_end():
+    """Both scrapers on the mock portal, keeping rows in memory."""
+    with MockPortal(last_id=20, density=0.5) as portal:
+        found = sum(map(portal.has_processes, range(1, 21)))
+        results = bench(portal, [2, 8], max_misses=10)
+    for result in results:
+        assert result["incidents"] == found * 4
+        assert result["ids_per_s"] > 0 and result["peak_rss_mb"] > 0
+        assert result["search_p50_ms"] <= result["search_p99_ms"]
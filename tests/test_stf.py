@@ -1,14 +1,35 @@
 """STF tests."""
+from concurrent.futures import ThreadPoolExecutor
 from datetime import date, datetime
 from typing import List
+import asyncio
+import json
+import lxml.etree
+import multiprocessing
 import os
 import psycopg2 as pg
+import pyarrow.dataset
 import pytest
+import requests
 import yaml
 
+from db.db_bulk import copy_value
 from db.db_config import config
+from db.db_intern import Interner
+from db.db_leases import LeaseManager
 from db.db_testing import DBTester
+from db.db_writer import BatchWriter
+from mock_portal import load_fixture, MockPortal
+from utils.cache import ResponseCache
+from utils import funcs
+from utils.funcs import get_session, parse_html, set_cache
+from utils.governor import backoff, Governor
+from utils import metrics
+from utils.parsers import parse_details, parse_parts
+from utils.scheduler import IdScheduler
 import STF
+import STF_async
+import STF_export
 
 # Read yml config file
 with open("utils/config.yml") as ymlfile:
@@ -73,6 +94,956 @@ class TestDBUtils:
                          ("stf_scrap_log",))
             assert curs.fetchone()[0]
 
+    def test_batch_writer(self):
+        """Test batching and collapsing of keyed rows."""
+        db_params = cfg["testing"]["db_params"]
+        today = datetime.today().date()
+        DBTester("stf_scrap_log", cfg["sql"]["scrap_log"]["create"],
+                 db_params)
+        writer = BatchWriter(db_params, batch_size=3)
+        sql = cfg["sql"]["scrap_log"]["insert_batch"]
+        for last_id in (5, 9, 7):
+            writer.add(sql, ("TEST", last_id, today), key="TEST")
+        writer.add(sql, ("TEST2", 1, today), key="TEST2")
+
+        with pg.connect(**db_params) as conn, conn.cursor() as curs:
+            # Nothing is written before the batch is full
+            curs.execute(cfg["sql"]["scrap_log"]["select"]["code"],
+                         ("TEST2",))
+            assert curs.fetchall() == []
+            writer.add(sql, ("TEST3", 1, today), key="TEST3")
+            conn.commit()
+
+            curs.execute(cfg["sql"]["scrap_log"]["select"]["code"],
+                         ("TEST",))
+            assert curs.fetchall() == [(9,)]
+            curs.execute(cfg["sql"]["scrap_log"]["select"]["code"],
+                         ("TEST3",))
+            assert curs.fetchall() == [(1,)]
+
+            # The last row of a key is kept when asked for
+            for last_id in (5, 3):
+                writer.add(sql, ("TEST4", last_id, today), key="TEST4",
+                           latest=True)
+            writer.flush()
+            conn.commit()
+            curs.execute(cfg["sql"]["scrap_log"]["select"]["code"],
+                         ("TEST4",))
+            assert curs.fetchall() == [(3,)]
+
+
+class TestUtils:
+    """Test utility functions."""
+
+    def test_shared_session(self):
+        """Test reuse and pool size of the shared HTTP session."""
+        session = get_session()
+        assert session is get_session()
+
+        adapter = session.get_adapter(cfg["urls"]["search"])
+        assert adapter._pool_maxsize == cfg["threads"]["max_workers"] \
+            * cfg["requests"]["pool"]["per_worker"]
+
+    def test_bounded_map(self):
+        """Items must be pulled only as pending work finishes."""
+        pulled = []
+
+        def items():
+            for item in range(100):
+                pulled.append(item)
+                yield item
+
+        with ThreadPoolExecutor(2) as executor:
+            results = funcs.bounded_map(executor, lambda x: x * 2, items(), 4)
+            assert next(results) in range(0, 8, 2)
+            assert len(pulled) == 4
+            assert sorted([next(results)] + list(results))[-1] == 198
+        assert len(pulled) == 100
+
+    def test_governor(self):
+        """Test AIMD concurrency limits and backoff delays."""
+        governor = Governor(rate=1000, burst=10, min_concurrency=2,
+                            max_concurrency=8, target_latency=1)
+        governor.acquire()
+        governor.release(0.1, ok=False)
+        assert governor.limit == 4
+        # Decreases are spaced by 'target_latency'
+        governor.acquire()
+        governor.release(0.1, ok=False)
+        assert governor.limit == 4
+        # About one more request per window of successes
+        for _ in range(4):
+            governor.acquire()
+            governor.release(0.1, ok=True)
+        assert 4.9 < governor.limit < 5
+        assert governor.in_flight == 0
+
+        for attempt in range(10):
+            assert 0 <= backoff(attempt, 0.5, 4) <= min(4, 0.5 * 2 ** attempt)
+
+    def test_governor_async(self):
+        """Coroutines waiting for a slot must sleep until one is freed."""
+        governor = Governor(rate=1e6, burst=1e6, min_concurrency=1,
+                            max_concurrency=1, target_latency=1)
+        attempts = 0
+        try_acquire = governor._try_acquire
+
+        def counted():
+            nonlocal attempts
+            attempts += 1
+            return try_acquire()
+
+        governor._try_acquire = counted
+
+        async def request():
+            await governor.acquire_async()
+            await asyncio.sleep(0.01)
+            governor.release(0.01, ok=True)
+
+        async def requests_waiting():
+            governor.acquire()
+            tasks = [asyncio.create_task(request()) for _ in range(20)]
+            await asyncio.sleep(0.2)
+            # Each waiting coroutine tried once
+            assert attempts == 1 + 20
+            # A cancelled waiter must not keep the slot it was woken for
+            tasks[0].cancel()
+            governor.release(0.01, ok=True)
+            await asyncio.wait_for(asyncio.gather(*tasks[1:]), 5)
+
+        asyncio.run(requests_waiting())
+        assert governor.in_flight == 0
+        assert attempts == 1 + 20 + 19
+
+    def test_fetch_retries(self, monkeypatch):
+        """Failed requests must be retried until the portal answers."""
+        monkeypatch.setitem(funcs.cfg["requests"], "retries", {
+            **funcs.cfg["requests"]["retries"], "total": 20,
+            "backoff_base": 0.001, "backoff_cap": 0.001})
+        with MockPortal(error_rate=0.5) as portal:
+            for id_stf in range(1, 11):
+                assert funcs.fetch(
+                    portal.urls["search"].format(classe="", num=id_stf),
+                    "search")
+            assert portal.hits["listarProcessos"] > 10
+
+        monkeypatch.setitem(funcs.cfg["requests"]["retries"], "total", 0)
+        with MockPortal(error_rate=1) as portal:
+            with pytest.raises(requests.HTTPError):
+                funcs.fetch(portal.urls["search"].format(classe="", num=1),
+                            "search")
+
+
+class TestMetrics:
+    """Test stage metrics and their exports."""
+
+    db_params = cfg["testing"]["db_params"]
+
+    def test_metrics_export(self):
+        """Test histograms and the Prometheus and JSON endpoints."""
+        registry = metrics.Metrics()
+        for latency in (0.002, 0.003, 0.004, 0.2):
+            registry.observe("fetch_seconds", latency, endpoint="search")
+        registry.inc("ids_total", 3)
+        histogram = registry.histograms[
+            ("fetch_seconds", (("endpoint", "search"),))]
+        assert 0.0025 <= histogram.quantile(0.5) <= 0.005
+        assert 0.1 <= histogram.quantile(0.99) <= 0.25
+
+        text = registry.prometheus()
+        assert "ids_total 3" in text
+        assert 'fetch_seconds_bucket{endpoint="search",le="0.005"} 3' in text
+        assert 'fetch_seconds_bucket{endpoint="search",le="+Inf"} 4' in text
+        assert 'fetch_seconds_count{endpoint="search"} 4' in text
+
+        metrics.metrics.inc("test_total")
+        server = metrics.serve(0)
+        try:
+            url = f"http://127.0.0.1:{server.server_address[1]}"
+            assert "test_total 1" in requests.get(f"{url}/metrics").text
+            assert requests.get(f"{url}/metrics.json").json()[
+                "counters"]["test_total"]["value"] == 1
+        finally:
+            server.shutdown()
+            server.server_close()
+            metrics.metrics.reset()
+
+    def test_scraper_metrics(self, monkeypatch, tmp_path):
+        """A search run must write its snapshot and sampled stacks."""
+        monkeypatch.setitem(metrics.cfg, "metrics", {
+            **metrics.cfg["metrics"], "snapshot": str(tmp_path / "run.json"),
+            "profile": str(tmp_path / "run.stacks")})
+        with pg.connect(**self.db_params) as conn, conn.cursor() as curs:
+            curs.execute(cfg["testing"]["sql"]["drop_all"])
+            conn.commit()
+
+        metrics.metrics.reset()
+        with MockPortal(last_id=3) as portal:
+            scraper = STF.SearchScraper(self.db_params)
+            scraper.urls = portal.urls
+            scraper.step = 5
+            scraper.start(mode="max")
+
+        with open(tmp_path / "run.json") as snapshot:
+            counters = json.load(snapshot)["counters"]
+        assert counters["ids_total"]["value"] == 5
+        assert counters["ids_with_processes_total"]["value"] == 3
+        assert counters[
+            'http_requests_total{endpoint="search",status="200"}'
+            ]["value"] == 5
+        # Processes, scrap log updates and the checkpoint of the run
+        assert counters["db_rows_total"]["value"] == 12 + 4 + 1
+        with open(tmp_path / "run.stacks") as stacks:
+            assert "STF.py:start" in stacks.read()
+        metrics.metrics.reset()
+
+
+class TestParsers:
+    """Test parsers against saved pages."""
+
+    def test_parse_details(self):
+        """Test the record parsed from the three tabs of a process."""
+        details = parse_details(
+            2641263, parse_html(load_fixture("detalhe.html")),
+            parse_html(load_fixture("abaPartes.html")),
+            parse_html(load_fixture("abaInformacoes.html")))
+        assert details.classe_processo == \
+            "Arguição de Descumprimento de Preceito Fundamental"
+        assert details.partes[1] == ("ADV.(A/S)", "PAULO MACHADO GUIMARÃES")
+        assert details.assuntos[0].startswith("DIREITO ADMINISTRATIVO")
+        assert details.data_protocolo == date(1936, 11, 23)
+        assert details.numeros_origem == ("1234", "5678")
+
+        # Records are immutable
+        with pytest.raises(AttributeError):
+            details.origem = ""
+
+    def test_streamed_pages(self):
+        """Pages parsed in chunks must match pages parsed at once."""
+        page = load_fixture("abaPartes.html")
+        # Split multibyte characters between chunks too
+        streamed = funcs.read_page(
+            (page[i:i + 7] for i in range(0, len(page), 7)), keep=True)
+        assert streamed.content == page
+        assert parse_parts(streamed.close()) == parse_parts(parse_html(page))
+
+        for empty in ([], [b" \n"]):
+            with pytest.raises(lxml.etree.ParserError):
+                funcs.read_page(empty).close()
+
+
+class TestResponseCache:
+    """Test the raw response cache and replay mode."""
+
+    db_params = cfg["testing"]["db_params"]
+
+    def test_eviction(self, tmp_path):
+        """Test storage and eviction of least recently used pages."""
+        cache = ResponseCache(str(tmp_path), max_bytes=2000)
+        pages = [os.urandom(900) for _ in range(3)]
+        for number, page in enumerate(pages):
+            cache.put(f"http://portal/page?n={number}", page)
+            if number == 0:
+                os.utime(cache._file(cache.key("http://portal/page?n=0")),
+                         (0, 0))
+        # The oldest page must be evicted
+        assert cache.get("http://portal/page?n=0") is None
+        assert cache.get("http://other/page?n=2") == pages[2]
+        assert cache.size <= 2000
+
+    def test_replay(self, tmp_path):
+        """Re-parse processes only from stored pages."""
+        with pg.connect(**self.db_params) as conn, conn.cursor() as curs:
+            curs.execute(cfg["testing"]["sql"]["drop_all"])
+            conn.commit()
+
+        set_cache(ResponseCache(str(tmp_path), 10 ** 7, "record"))
+        try:
+            with MockPortal() as portal:
+                search_scraper = STF.SearchScraper(self.db_params)
+                search_scraper.urls = portal.urls
+                search_scraper.step = 2
+                assert search_scraper.start(mode="max")
+                process_scraper = STF.ProcessScraper(self.db_params)
+                process_scraper.urls = portal.urls
+                assert process_scraper.start()
+
+            with pg.connect(**self.db_params) as conn, conn.cursor() as curs:
+                curs.execute("UPDATE stf_data SET origem = NULL;")
+                conn.commit()
+
+                # The portal is gone, pages must come from the cache
+                set_cache(ResponseCache(str(tmp_path), 10 ** 7, "replay"))
+                process_scraper.start(reparse=True)
+                curs.execute("SELECT DISTINCT origem FROM stf_data;")
+                assert curs.fetchall() == [("DISTRITO FEDERAL",)]
+
+                # Ids that were never scraped are skipped
+                assert search_scraper.scrap_incidents(3) is None
+        finally:
+            set_cache(ResponseCache("cache", 0, "disabled"))
+
+
+class TestIdScheduler:
+    """Test the sliding window scheduling of search ids."""
+
+    db_params = cfg["testing"]["db_params"]
+
+    def test_stop_after_misses(self):
+        """Ids must stop after ``max_misses`` misses past the last hit."""
+        scheduler = IdScheduler(1, max_in_flight=4, max_misses=10)
+        issued = []
+        while (id_stf := scheduler.next()) is not None:
+            issued.append(id_stf)
+            scheduler.finish(id_stf, id_stf in (1, 2, 9))
+        assert issued == list(range(1, 20))
+        assert scheduler.hits == 3
+
+        # The frontier only moves past ids finished in order
+        scheduler = IdScheduler(1, max_in_flight=4, max_misses=10)
+        ids = [scheduler.next() for _ in range(3)]
+        scheduler.finish(ids[1], False)
+        assert scheduler.frontier == 1
+        scheduler.finish(ids[0], False)
+        assert scheduler.frontier == 3
+
+        # 'limit' caps the ids issued
+        scheduler = IdScheduler(5, max_in_flight=4, max_misses=10, limit=2)
+        assert [scheduler.next(), scheduler.next(), scheduler.next()] == \
+            [5, 6, None]
+
+    def test_search_until_misses(self, monkeypatch):
+        """A single run must scrap all ids of a sparse id space."""
+        monkeypatch.setitem(STF.cfg["scheduler"], "max_misses", 20)
+        with pg.connect(**self.db_params) as conn, conn.cursor() as curs:
+            curs.execute(cfg["testing"]["sql"]["drop_all"])
+            conn.commit()
+
+        with MockPortal(last_id=60, density=0.5) as portal:
+            scraper = STF.SearchScraper(self.db_params)
+            scraper.urls = portal.urls
+            assert scraper.start(mode="max")
+            requested = portal.hits["listarProcessos"]
+            found = [id_stf for id_stf in range(1, 61)
+                     if portal.has_processes(id_stf)]
+
+        with pg.connect(**self.db_params) as conn, conn.cursor() as curs:
+            curs.execute("SELECT DISTINCT id_stf FROM stf_data ORDER BY 1;")
+            assert [row[0] for row in curs.fetchall()] == found
+        # No more than the misses and a pool of ids past the last hit
+        assert requested <= found[-1] + 20 + cfg["threads"]["max_workers"]
+
+
+def run_leased_worker(db_params: dict, urls: dict) -> None:
+    """Search ids and fill processes with leases, as a worker process."""
+    STF.cfg["scheduler"]["max_misses"] = 20
+    STF.cfg["leases"]["range_size"] = 5
+    STF.cfg["leases"]["poll_interval"] = 0.1
+    search_scraper = STF.SearchScraper(db_params)
+    search_scraper.urls = urls
+    search_scraper.start(mode="max", leased=True)
+    process_scraper = STF.ProcessScraper(db_params)
+    process_scraper.urls = urls
+    process_scraper.start(leased=True)
+
+
+class TestLeases:
+    """Test splitting work between workers with leases."""
+
+    db_params = cfg["testing"]["db_params"]
+
+    def test_lease_expiry(self):
+        """Leases must be exclusive until they expire."""
+        with pg.connect(**self.db_params) as conn, conn.cursor() as curs:
+            curs.execute(cfg["testing"]["sql"]["drop_all"])
+            conn.commit()
+        DBTester("stf_data", cfg["sql"]["data"]["create"], self.db_params)
+        # Leases of 'crashed' expire as soon as they are taken
+        crashed = LeaseManager(cfg["sql"]["leases"], self.db_params,
+                               owner="crashed", expiry=-1)
+        worker = LeaseManager(cfg["sql"]["leases"], self.db_params,
+                              owner="worker")
+
+        assert crashed.claim_range("max", 1, 10, 20) == (1, 11)
+        assert worker.claim_range("max", 1, 10, 20) == (1, 11)
+        assert crashed.claim_range("max", 1, 10, 20) == (11, 21)
+        assert worker.claim_range("max", 1, 10, 20) == (11, 21)
+        assert worker.active("max")
+        worker.complete_range("max", 1, 3)
+        worker.complete_range("max", 11, None)
+        # Ranges past 20 misses after the last hit are not leased
+        assert worker.claim_range("max", 1, 10, 20) == (21, 31)
+        worker.complete_range("max", 21, None)
+        assert worker.claim_range("max", 1, 10, 20) is None
+        assert not worker.active("max")
+        worker.reset("max")
+        assert worker.claim_range("max", 40, 10, 20) == (40, 50)
+
+        with pg.connect(**self.db_params) as conn, conn.cursor() as curs:
+            for incidente in range(1, 6):
+                curs.execute(cfg["sql"]["data"]["insert"], (
+                    incidente, "", 1, "ADI", date.today(), 1, 1,
+                    date.today()))
+            conn.commit()
+        assert crashed.claim_incidents(3) == [1, 2, 3]
+        assert worker.claim_incidents(10) == [1, 2, 3, 4, 5]
+        assert crashed.claim_incidents(10) == []
+
+        # Leases of processes no longer pending are dropped
+        with pg.connect(**self.db_params) as conn, conn.cursor() as curs:
+            curs.execute("""UPDATE stf_data SET status = 'done'
+                WHERE incidente <= 4;""")
+            conn.commit()
+        assert worker.claim_incidents(10) == []
+        with pg.connect(**self.db_params) as conn, conn.cursor() as curs:
+            curs.execute("SELECT incidente FROM stf_incident_leases;")
+            assert curs.fetchall() == [(5,)]
+
+    def test_leased_workers(self):
+        """Worker processes must split ids and incidents without repeats."""
+        with pg.connect(**self.db_params) as conn, conn.cursor() as curs:
+            curs.execute(cfg["testing"]["sql"]["drop_all"])
+            conn.commit()
+
+        context = multiprocessing.get_context("spawn")
+        with MockPortal(last_id=60, density=0.5) as portal:
+            workers = [context.Process(target=run_leased_worker,
+                                       args=(self.db_params, portal.urls))
+                       for _ in range(3)]
+            for worker in workers:
+                worker.start()
+            for worker in workers:
+                worker.join(120)
+                assert worker.exitcode == 0
+            found = [id_stf for id_stf in range(1, 61)
+                     if portal.has_processes(id_stf)]
+
+            # Each id and each process was requested once
+            assert set(portal.searches.values()) == {1}
+            assert portal.hits["detalhe"] == len(found) * 4
+            assert found[-1] + 20 <= len(portal.searches) \
+                <= found[-1] + 20 + 5
+
+        with pg.connect(**self.db_params) as conn, conn.cursor() as curs:
+            curs.execute("SELECT DISTINCT id_stf FROM stf_data ORDER BY 1;")
+            assert [row[0] for row in curs.fetchall()] == found
+            curs.execute(cfg["sql"]["data"]["select"]["incomplete"])
+            assert curs.fetchall() == []
+            curs.execute("SELECT COUNT(DISTINCT owner) FROM stf_id_leases;")
+            assert curs.fetchone()[0] > 1
+
+
+class TestCodeMode:
+    """Test searches of a single code against the local mock portal."""
+
+    db_params = cfg["testing"]["db_params"]
+
+    @pytest.mark.parametrize("scraper_class", [
+        STF.SearchScraper, STF_async.AsyncSearchScraper])
+    def test_code_mode(self, scraper_class):
+        """Only pages of the given code must be requested and written."""
+        with pg.connect(**self.db_params) as conn, conn.cursor() as curs:
+            curs.execute(cfg["testing"]["sql"]["drop_all"])
+            conn.commit()
+
+        with MockPortal(last_id=3) as portal:
+            scraper = scraper_class(self.db_params)
+            scraper.urls = portal.urls
+            scraper.step = 3
+            assert scraper.start(mode="code", code="HC")
+            assert {classe for classe, _ in portal.searches} == {"HC"}
+
+        with pg.connect(**self.db_params) as conn, conn.cursor() as curs:
+            curs.execute("""SELECT classe_processo_sigla, COUNT(*)
+                FROM stf_data GROUP BY 1""")
+            assert curs.fetchall() == [("HC", 3)]
+            curs.execute(cfg["sql"]["scrap_log"]["select"]["all"])
+            assert curs.fetchall() == [("HC", 3)]
+
+
+class TestPipeline:
+    """Test the combined search and process pipeline."""
+
+    db_params = cfg["testing"]["db_params"]
+
+    def test_pipeline(self, monkeypatch):
+        """New and left over incidents must be scraped once each."""
+        monkeypatch.setitem(STF.cfg["pipeline"], "queue_size", 2)
+        monkeypatch.setitem(STF.cfg["scheduler"], "max_misses", 10)
+        with pg.connect(**self.db_params) as conn, conn.cursor() as curs:
+            curs.execute(cfg["testing"]["sql"]["drop_all"])
+            conn.commit()
+
+        with MockPortal(last_id=6) as portal:
+            # Processes of id 1 are left incomplete by an earlier run
+            search_scraper = STF.SearchScraper(self.db_params)
+            search_scraper.urls = portal.urls
+            search_scraper.step = 1
+            search_scraper.start(mode="max")
+
+            pipeline = STF.Pipeline(self.db_params)
+            pipeline.search_scraper.urls = portal.urls
+            pipeline.process_scraper.urls = portal.urls
+            assert pipeline.start(mode="max")
+            assert portal.hits["detalhe"] == 6 * 4
+            assert not pipeline.search_scraper.stopping.is_set()
+
+        with pg.connect(**self.db_params) as conn, conn.cursor() as curs:
+            curs.execute(cfg["sql"]["data"]["select"]["all_incidents"])
+            assert len(curs.fetchall()) == 6 * 4
+            curs.execute(cfg["sql"]["data"]["select"]["incomplete"])
+            assert curs.fetchall() == []
+
+    def test_pipeline_details_error(self, monkeypatch):
+        """Errors of process workers stop the search and are raised."""
+        monkeypatch.setitem(STF.cfg["pipeline"], "queue_size", 2)
+        monkeypatch.setitem(STF.cfg["database"], "batch_size", 4)
+        with pg.connect(**self.db_params) as conn, conn.cursor() as curs:
+            curs.execute(cfg["testing"]["sql"]["drop_all"])
+            conn.commit()
+
+        def broken(details):
+            raise RuntimeError("Broken details writer")
+
+        with MockPortal(last_id=50) as portal:
+            pipeline = STF.Pipeline(self.db_params)
+            pipeline.search_scraper.urls = portal.urls
+            pipeline.process_scraper.urls = portal.urls
+            monkeypatch.setattr(pipeline.process_scraper, "_write_details",
+                                broken)
+            with pytest.raises(RuntimeError, match="Broken details writer"):
+                pipeline.start(mode="max")
+            assert not pipeline.search_scraper.stopping.is_set()
+            assert len(portal.searches) < 50
+
+        with pg.connect(**self.db_params) as conn, conn.cursor() as curs:
+            curs.execute("SELECT COUNT(*) FROM stf_failures;")
+            assert curs.fetchone()[0] == 0
+            # The stopped run is resumed by the next one
+            curs.execute("SELECT done FROM stf_id_checkpoints;")
+            assert curs.fetchall() == [(False,)]
+
+
+class TestWorkState:
+    """Test work state tracking of processes."""
+
+    db_params = cfg["testing"]["db_params"]
+
+    def test_migration(self):
+        """Tables without work state must be migrated keeping states."""
+        with pg.connect(**self.db_params) as conn, conn.cursor() as curs:
+            curs.execute(cfg["testing"]["sql"]["drop_all"])
+            # Table as created before work state columns
+            curs.execute("""CREATE TABLE stf_data (
+                incidente INTEGER PRIMARY KEY, numero_unico TEXT,
+                id_stf INTEGER NOT NULL, classe_processo_sigla TEXT NOT NULL,
+                data_protocolo DATE NOT NULL, meio_id SMALLINT NOT NULL,
+                tipo_id SMALLINT NOT NULL, classe_processo TEXT,
+                partes TEXT [], assuntos TEXT [], orgao_origem TEXT,
+                origem TEXT, numeros_origem TEXT [],
+                scrap_date DATE NOT NULL);""")
+            curs.execute("""INSERT INTO stf_data VALUES
+                (1, '', 1, 'HC', now(), 1, 1, NULL, NULL, NULL, NULL, NULL,
+                 NULL, now()),
+                (2, '', 1, 'HC', now(), 1, 1, 'HABEAS CORPUS', NULL, NULL,
+                 NULL, NULL, NULL, now());""")
+            conn.commit()
+
+        STF.ProcessScraper(self.db_params)
+        with pg.connect(**self.db_params) as conn, conn.cursor() as curs:
+            curs.execute(
+                "SELECT incidente, status FROM stf_data ORDER BY 1;")
+            assert curs.fetchall() == [(1, "pending"), (2, "done")]
+            curs.execute(cfg["sql"]["data"]["select"]["incomplete"])
+            assert curs.fetchall() == [(1,)]
+            curs.execute("""SELECT indexdef FROM pg_indexes
+                WHERE indexname = 'stf_data_pending_idx';""")
+            assert "WHERE (status = 'pending'" in curs.fetchone()[0]
+            curs.execute("""SELECT COUNT(*) FROM pg_indexes
+                WHERE indexname = 'stf_data_updated_at_idx';""")
+            assert curs.fetchone()[0] == 1
+            # Writes set the time of the change
+            curs.execute("SELECT MAX(updated_at) FROM stf_data;")
+            migrated = curs.fetchone()[0]
+            conn.commit()
+            curs.execute("""UPDATE stf_data SET origem = 'changed'
+                WHERE incidente = 1;""")
+            conn.commit()
+            curs.execute("""SELECT incidente FROM stf_data
+                WHERE updated_at > %s;""", (migrated,))
+            assert curs.fetchall() == [(1,)]
+
+    @pytest.mark.parametrize("scraper_class", [
+        STF.ProcessScraper, STF_async.AsyncProcessScraper])
+    def test_failed_processes(self, monkeypatch, scraper_class):
+        """Processes failing ``max_attempts`` times must not be retried."""
+        monkeypatch.setitem(funcs.cfg["requests"]["retries"], "total", 0)
+        monkeypatch.setitem(STF.cfg["failures"], "max_attempts", 2)
+        monkeypatch.setitem(STF.cfg["failures"], "retry_delay", 0)
+        with pg.connect(**self.db_params) as conn, conn.cursor() as curs:
+            curs.execute(cfg["testing"]["sql"]["drop_all"])
+            conn.commit()
+
+        with MockPortal(last_id=1) as portal:
+            search_scraper = STF.SearchScraper(self.db_params)
+            search_scraper.urls = portal.urls
+            search_scraper.step = 1
+            search_scraper.start(mode="max")
+
+            portal.error_rate = 1
+            for attempt in (1, 2):
+                scraper = scraper_class(self.db_params)
+                scraper.urls = portal.urls
+                assert scraper.start()
+                with pg.connect(**self.db_params) as conn, \
+                        conn.cursor() as curs:
+                    curs.execute("SELECT DISTINCT status, attempts "
+                                 "FROM stf_data;")
+                    assert curs.fetchall() == [
+                        ("pending" if attempt == 1 else "failed", attempt)]
+
+        with pg.connect(**self.db_params) as conn, conn.cursor() as curs:
+            curs.execute(cfg["sql"]["data"]["select"]["incomplete"])
+            assert curs.fetchall() == []
+            curs.execute("SELECT DISTINCT kind, attempts FROM stf_failures;")
+            assert curs.fetchall() == [("details", 2)]
+
+
+class TestResume:
+    """Test the failure journal and resumed search runs."""
+
+    db_params = cfg["testing"]["db_params"]
+
+    def test_failed_ids(self, monkeypatch):
+        """Failed ids must be journaled and retried by the next run."""
+        with pg.connect(**self.db_params) as conn, conn.cursor() as curs:
+            curs.execute(cfg["testing"]["sql"]["drop_all"])
+            conn.commit()
+        failing = {2}
+        fetch = STF.SearchScraper._fetch
+
+        def broken_fetch(scraper, id_stf):
+            if id_stf in failing:
+                raise IndexError("list index out of range")
+            return fetch(scraper, id_stf)
+
+        monkeypatch.setattr(STF.SearchScraper, "_fetch", broken_fetch)
+        with MockPortal(last_id=4) as portal:
+            scraper = STF.SearchScraper(self.db_params)
+            scraper.urls = portal.urls
+            scraper.step = 4
+            assert scraper.start(mode="max")
+            with pg.connect(**self.db_params) as conn, conn.cursor() as curs:
+                curs.execute(
+                    "SELECT kind, scope, id, error FROM stf_failures;")
+                assert curs.fetchall() == [
+                    ("search", "max", 2,
+                     "IndexError('list index out of range')")]
+                curs.execute("SELECT DISTINCT id_stf FROM stf_data;")
+                assert 2 not in {row[0] for row in curs.fetchall()}
+
+            failing.clear()
+            scraper.start(mode="max")
+            assert portal.searches[("", "2")] == 1
+
+        with pg.connect(**self.db_params) as conn, conn.cursor() as curs:
+            curs.execute("SELECT COUNT(*) FROM stf_failures;")
+            assert curs.fetchone()[0] == 0
+            curs.execute("SELECT COUNT(*) FROM stf_data WHERE id_stf = 2;")
+            assert curs.fetchone()[0] == 4
+
+    def test_failed_writes(self, monkeypatch):
+        """Failed writes must stop the run without losing checkpoints."""
+        monkeypatch.setitem(STF.cfg["database"], "batch_size", 4)
+        with pg.connect(**self.db_params) as conn, conn.cursor() as curs:
+            curs.execute(cfg["testing"]["sql"]["drop_all"])
+            conn.commit()
+        inserts = []
+
+        def broken_write(curs, sql, template, rows, fetch):
+            # The second batch of rows fails once
+            if sql == cfg["sql"]["data"]["insert_batch"]:
+                inserts.append(rows)
+                if len(inserts) == 2:
+                    raise pg.OperationalError("Connection lost")
+            return BatchWriter._write(scraper.writer, curs, sql, template,
+                                      rows, fetch)
+
+        with MockPortal(last_id=8, density=0.5) as portal:
+            scraper = STF.SearchScraper(self.db_params)
+            scraper.urls = portal.urls
+            scraper.step = 8
+            monkeypatch.setattr(scraper.writer, "_write", broken_write)
+            with pytest.raises(pg.OperationalError):
+                scraper.start(mode="max")
+            with pg.connect(**self.db_params) as conn, conn.cursor() as curs:
+                curs.execute("SELECT COUNT(*) FROM stf_failures;")
+                assert curs.fetchone()[0] == 0
+                # Rows of the failed batch are written by the next one
+                curs.execute("SELECT incidente FROM stf_data;")
+                assert {row[0] for row in inserts[1]} <= \
+                    {row[0] for row in curs.fetchall()}
+                curs.execute("SELECT DISTINCT id_stf FROM stf_data;")
+                written = {row[0] for row in curs.fetchall()}
+                curs.execute("SELECT range_end FROM stf_id_checkpoints;")
+                ends = curs.fetchall()
+                assert ends, "some batch must be committed"
+                # Ids with processes before the checkpoint were all written
+                assert {id_stf for id_stf in range(1, ends[0][0])
+                        if portal.has_processes(id_stf)} <= written
+
+            monkeypatch.delattr(scraper.writer, "_write")
+            scraper.start(mode="max")
+
+        with pg.connect(**self.db_params) as conn, conn.cursor() as curs:
+            curs.execute("SELECT DISTINCT id_stf FROM stf_data;")
+            assert {row[0] for row in curs.fetchall()} == {
+                id_stf for id_stf in range(1, 9)
+                if portal.has_processes(id_stf)}
+
+    def test_resume(self):
+        """Interrupted runs must be resumed from their checkpoint."""
+        with pg.connect(**self.db_params) as conn, conn.cursor() as curs:
+            curs.execute(cfg["testing"]["sql"]["drop_all"])
+            conn.commit()
+        with MockPortal(last_id=4) as portal:
+            scraper = STF.SearchScraper(self.db_params)
+            scraper.urls = portal.urls
+            scraper.step = 4
+            scraper.start(mode="max")
+            with pg.connect(**self.db_params) as conn, conn.cursor() as curs:
+                curs.execute("""SELECT range_start, range_end, done
+                    FROM stf_id_checkpoints;""")
+                assert curs.fetchall() == [(1, 5, True)]
+                # A later run stopped once ids up to 5 were finished
+                curs.execute("""INSERT INTO stf_id_checkpoints
+                    VALUES ('max', 4, 6, FALSE, now());""")
+                curs.execute("UPDATE stf_scrap_log SET last_id = 9;")
+                conn.commit()
+
+            portal.searches.clear()
+            scraper.start(mode="max")
+            assert min(int(num) for _, num in portal.searches) == 6
+
+        with pg.connect(**self.db_params) as conn, conn.cursor() as curs:
+            curs.execute("SELECT bool_and(done) FROM stf_id_checkpoints;")
+            assert curs.fetchone()[0]
+
+    def test_resume_past_start(self):
+        """Checkpoints past the starting id must be resumed as well."""
+        with pg.connect(**self.db_params) as conn, conn.cursor() as curs:
+            curs.execute(cfg["testing"]["sql"]["drop_all"])
+            conn.commit()
+        with MockPortal(last_id=4) as portal:
+            scraper = STF.SearchScraper(self.db_params)
+            scraper.urls = portal.urls
+            scraper.step = 4
+            scraper.start(mode="max")
+            portal.last_id = 12
+            with pg.connect(**self.db_params) as conn, conn.cursor() as curs:
+                # A later run found processes up to 8 and stopped at 9
+                curs.execute("""INSERT INTO stf_id_checkpoints (
+                        scope, range_start, range_end, last_hit
+                    ) VALUES ('max', 4, 9, 8);""")
+                curs.execute("UPDATE stf_scrap_log SET last_id = 2;")
+                conn.commit()
+
+            portal.searches.clear()
+            scraper.start(mode="max")
+            assert sorted(int(num) for _, num in portal.searches) \
+                == [9, 10, 11, 12]
+
+        with pg.connect(**self.db_params) as conn, conn.cursor() as curs:
+            curs.execute("""SELECT range_start, range_end, last_hit, done
+                FROM stf_id_checkpoints ORDER BY range_start;""")
+            assert curs.fetchall() == [
+                (1, 5, 4, True), (4, 9, 8, True), (9, 13, 12, True)]
+
+
+class TestBulk:
+    """Test bulk writes through staging tables."""
+
+    db_params = cfg["testing"]["db_params"]
+
+    def scrap(self, portal):
+        """Scrap the mock portal and return all written rows."""
+        with pg.connect(**self.db_params) as conn, conn.cursor() as curs:
+            curs.execute(cfg["testing"]["sql"]["drop_all"])
+            conn.commit()
+        search_scraper = STF.SearchScraper(self.db_params)
+        search_scraper.urls = portal.urls
+        search_scraper.step = 4
+        assert search_scraper.start(mode="max")
+        process_scraper = STF.ProcessScraper(self.db_params)
+        process_scraper.urls = portal.urls
+        assert process_scraper.start()
+        with pg.connect(**self.db_params) as conn, conn.cursor() as curs:
+            curs.execute("SELECT * FROM stf_data ORDER BY incidente;")
+            # Without 'updated_at', the time of each run
+            data = [row[:-1] for row in curs.fetchall()]
+            curs.execute(cfg["sql"]["scrap_log"]["select"]["all"])
+            return data, sorted(curs.fetchall())
+
+    def test_bulk_writes(self, monkeypatch):
+        """Bulk writes must write the same rows as batched writes."""
+        assert copy_value("a\tb\\c\nd") == "a\\tb\\\\c\\nd"
+        assert copy_value(["a", "b"]) == '["a", "b"]'
+        assert copy_value(None) == "\\N"
+        with MockPortal(last_id=4) as portal:
+            batched = self.scrap(portal)
+            monkeypatch.setitem(STF.cfg["database"], "bulk", True)
+            bulk = self.scrap(portal)
+        assert len(bulk[0]) == 4 * 4
+        assert bulk == batched
+        with pg.connect(**self.db_params) as conn, conn.cursor() as curs:
+            curs.execute("SELECT COUNT(*) FROM stf_data_update_stage;")
+            assert curs.fetchone()[0] == 0
+
+
+class TestExport:
+    """Test the Parquet export of ``stf_data``."""
+
+    db_params = cfg["testing"]["db_params"]
+
+    def test_export(self, tmp_path, monkeypatch):
+        """Exports must be partitioned and incremental."""
+        monkeypatch.setitem(STF.cfg["export"], "overlap", 0)
+        with pg.connect(**self.db_params) as conn, conn.cursor() as curs:
+            curs.execute(cfg["testing"]["sql"]["drop_all"])
+            conn.commit()
+        with MockPortal(last_id=3) as portal:
+            search_scraper = STF.SearchScraper(self.db_params)
+            search_scraper.urls = portal.urls
+            search_scraper.step = 3
+            search_scraper.start(mode="max")
+            process_scraper = STF.ProcessScraper(self.db_params)
+            process_scraper.urls = portal.urls
+            process_scraper.start()
+
+        exporter = STF_export.ParquetExporter(str(tmp_path), self.db_params)
+        assert exporter.start() == 12
+        with pg.connect(**self.db_params) as conn, conn.cursor() as curs:
+            curs.execute("SELECT MAX(updated_at) FROM stf_data;")
+            assert exporter.read_watermark() == curs.fetchone()[0]
+        dataset = pyarrow.dataset.dataset(tmp_path, partitioning="hive")
+        table = dataset.to_table()
+        assert table.num_rows == 12
+        assert set(table.column("classe").to_pylist()) == \
+            {"ADPF", "ADI", "HC", "Inq"}
+        assert table.column("classe").to_pylist() == \
+            table.column("classe_processo_sigla").to_pylist()
+        assert all(table.column("partes").to_pylist())
+        assert exporter.start() == 0
+
+        # Only rows changed since are exported, whatever their scrap date
+        with pg.connect(**self.db_params) as conn, conn.cursor() as curs:
+            curs.execute("""UPDATE stf_data SET origem = 'changed'
+                WHERE incidente IN (
+                    SELECT incidente FROM stf_data ORDER BY 1 LIMIT 2);""")
+            conn.commit()
+        assert exporter.start() == 2
+        assert exporter.start() == 0
+        assert pyarrow.dataset.dataset(
+            tmp_path, partitioning="hive").count_rows() == 14
+
+        # Rows changed while a run starts are exported again by the next one
+        monkeypatch.setitem(STF.cfg["export"], "overlap", 60)
+        with pg.connect(**self.db_params) as conn, conn.cursor() as curs:
+            curs.execute("""UPDATE stf_data SET origem = 'again'
+                WHERE incidente IN (
+                    SELECT incidente FROM stf_data ORDER BY 1 LIMIT 1);""")
+            conn.commit()
+        assert exporter.start() == 1
+        assert exporter.start() == 1
+
+    def test_export_details(self, tmp_path, monkeypatch):
+        """Details filled on the day of an export must be exported."""
+        monkeypatch.setitem(STF.cfg["export"], "overlap", 0)
+        with pg.connect(**self.db_params) as conn, conn.cursor() as curs:
+            curs.execute(cfg["testing"]["sql"]["drop_all"])
+            conn.commit()
+        exporter = STF_export.ParquetExporter(str(tmp_path), self.db_params)
+        with MockPortal(last_id=1) as portal:
+            search_scraper = STF.SearchScraper(self.db_params)
+            search_scraper.urls = portal.urls
+            search_scraper.step = 1
+            search_scraper.start(mode="max")
+            assert exporter.start() == 4
+            process_scraper = STF.ProcessScraper(self.db_params)
+            process_scraper.urls = portal.urls
+            process_scraper.start()
+        assert exporter.start() == 4
+        table = pyarrow.dataset.dataset(
+            tmp_path, partitioning="hive").to_table()
+        latest = {}
+        for row in table.to_pylist():
+            if row["incidente"] not in latest \
+                    or row["updated_at"] > latest[row["incidente"]][0]:
+                latest[row["incidente"]] = row["updated_at"], row["partes"]
+        assert len(latest) == 4
+        assert all(partes for _, partes in latest.values())
+
+
+class TestRelations:
+    """Test normalized parties, subjects and origin numbers."""
+
+    db_params = cfg["testing"]["db_params"]
+
+    def test_interner(self):
+        """Ids must be stable and the cache bounded."""
+        with pg.connect(**self.db_params) as conn, conn.cursor() as curs:
+            curs.execute(cfg["testing"]["sql"]["drop_all"])
+            conn.commit()
+        interner = Interner(cfg["sql"]["dimensions"]["subjects"],
+                            self.db_params, maxsize=2)
+        ids = interner.ids(["a", "b", "a", "c"])
+        assert ids[0] == ids[2] and len(set(ids)) == 3
+        assert list(interner._cache) == ["b", "c"]
+        assert interner.ids(["c", "a", "b"]) == [ids[3], ids[0], ids[1]]
+        assert Interner(cfg["sql"]["dimensions"]["subjects"],
+                        self.db_params).ids(["b"]) == [ids[1]]
+        assert interner.ids([]) == []
+
+    def test_relations(self):
+        """Relations must match the arrays of ``stf_data``."""
+        with pg.connect(**self.db_params) as conn, conn.cursor() as curs:
+            curs.execute(cfg["testing"]["sql"]["drop_all"])
+            conn.commit()
+        with MockPortal(last_id=2) as portal:
+            search_scraper = STF.SearchScraper(self.db_params)
+            search_scraper.urls = portal.urls
+            search_scraper.step = 2
+            search_scraper.start(mode="max")
+            process_scraper = STF.ProcessScraper(self.db_params)
+            process_scraper.urls = portal.urls
+            process_scraper.start()
+            # Writing a process again replaces its relations
+            process_scraper._write_relations(10, partes=[("A", "B")],
+                                             numeros_origem=[])
+            process_scraper.writer.flush()
+
+        with pg.connect(**self.db_params) as conn, conn.cursor() as curs:
+            curs.execute("""SELECT d.incidente, d.assuntos, array_agg(
+                    s.assunto ORDER BY r.position)
+                FROM stf_data AS d
+                JOIN stf_process_subjects AS r USING (incidente)
+                JOIN stf_subjects AS s ON s.id = r.subject_id
+                GROUP BY d.incidente, d.assuntos;""")
+            subjects = curs.fetchall()
+            assert len(subjects) == 2 * 4
+            assert all(assuntos == joined for _, assuntos, joined in subjects)
+            curs.execute("""SELECT count(*) FROM stf_process_parties
+                GROUP BY incidente ORDER BY incidente = 10;""")
+            assert [count for count, in curs.fetchall()] == [4] * 7 + [1]
+            curs.execute("""SELECT DISTINCT incidente
+                FROM stf_process_origins WHERE incidente = 10;""")
+            assert curs.fetchall() == []
+            curs.execute("""SELECT d.incidente FROM stf_parties AS p
+                JOIN stf_process_parties AS r ON r.party_id = p.id
+                JOIN stf_data AS d USING (incidente)
+                WHERE p.nome = 'B';""")
+            assert curs.fetchall() == [(10,)]
+
 
 class TestSTFSearchScraper:
     """Test STF Search Scraper."""
@@ -183,7 +1154,227 @@ class TestSTFProcessScraper:
 
             process_scraper.start()
 
-            # Check if all processes were filled
+            # Check if all processes were filled. Failed processes are not
+            # selected as incomplete until they can be retried, so the
+            # status and the detail columns are checked instead.
+            curs.execute("""SELECT incidente, status, partes IS NOT NULL
+                FROM stf_data ORDER BY incidente""")
+            assert curs.fetchall() == [
+                (1406899, "done", True), (2641263, "done", True)]
+            curs.execute("SELECT COUNT(*) FROM stf_failures;")
+            assert curs.fetchone()[0] == 0
+
+
+class TestAsyncScrapers:
+    """Test asynchronous scrapers against the local mock portal."""
+
+    db_params = cfg["testing"]["db_params"]
+
+    def test_async_search_scraper(self):
+        """Test ``max`` mode and written rows of the async search scraper."""
+        with pg.connect(**self.db_params) as conn, conn.cursor() as curs:
+            curs.execute(cfg["testing"]["sql"]["drop_all"])
+            conn.commit()
+
+        with MockPortal(last_id=3) as portal:
+            scraper = STF_async.AsyncSearchScraper(self.db_params)
+            scraper.urls = portal.urls
+            scraper.step = 5
+            assert scraper.start(mode="max")
+
+            async def search_invalid_id():
+                async with STF_async.client_session() as session:
+                    await scraper.scrap_incidents_async(session, "invalid id")
+
+            # Invalid ids must cause an error
+            with pytest.raises(Exception) as exc_info:
+                asyncio.run(search_invalid_id())
+            assert exc_info.value.args[0] == "Invalid id_stf: invalid id"
+
+        with pg.connect(**self.db_params) as conn, conn.cursor() as curs:
+            curs.execute(cfg["sql"]["data"]["select"]["all"])
+            # Three ids with four processes each
+            assert len(curs.fetchall()) == 12
+            curs.execute(cfg["sql"]["scrap_log"]["select"]["all"])
+            assert dict(curs.fetchall()) == \
+                {"ADPF": 3, "ADI": 3, "HC": 3, "Inq": 3}
+
+    def test_async_cancelled_request(self):
+        """Test governor slots are freed by cancelled requests."""
+        governor: Governor = funcs.get_governor("search")
+        in_flight: int = governor.in_flight
+
+        async def cancelled_request(url: str) -> None:
+            async with STF_async.client_session() as session:
+                with pytest.raises(asyncio.TimeoutError):
+                    await asyncio.wait_for(STF_async.async_requester(
+                        session, url), 0.1)
+
+        with MockPortal(latency=0.5) as portal:
+            asyncio.run(cancelled_request(
+                portal.urls["search"].format(classe="", num=1)))
+        assert governor.in_flight == in_flight
+
+    def test_async_process_scraper(self):
+        """Test details written by the async process scraper."""
+        with MockPortal() as portal:
+            scraper = STF_async.AsyncProcessScraper(self.db_params)
+            scraper.urls = portal.urls
+            assert scraper.start()
+
+        with pg.connect(**self.db_params) as conn, conn.cursor() as curs:
             curs.execute(cfg["sql"]["data"]["select"]["incomplete"])
-            data = curs.fetchall()
-            assert len(data) == 0
+            assert len(curs.fetchall()) == 0
+            curs.execute("""SELECT partes, assuntos, orgao_origem, origem,
+                numeros_origem FROM stf_data WHERE incidente = 10""")
+            partes, assuntos, orgao_origem, origem, numeros_origem = \
+                curs.fetchone()
+            assert len(partes) == 4
+            assert assuntos[1] == "DIREITO TRIBUTÁRIO; Impostos; " \
+                "IPTU/ Imposto Predial e Territorial Urbano"
+            assert orgao_origem == "SUPREMO TRIBUNAL FEDERAL"
+            assert origem == "DISTRITO FEDERAL"
+            assert numeros_origem == ["1234", "5678"]
+
+    def test_async_leased(self, monkeypatch):
+        """Leased async scrapers must scrap all ids and processes."""
+        monkeypatch.setitem(STF.cfg["scheduler"], "max_misses", 10)
+        monkeypatch.setitem(STF.cfg["leases"], "range_size", 5)
+        with pg.connect(**self.db_params) as conn, conn.cursor() as curs:
+            curs.execute(cfg["testing"]["sql"]["drop_all"])
+            conn.commit()
+
+        with MockPortal(last_id=12, density=0.5) as portal:
+            search_scraper = STF_async.AsyncSearchScraper(self.db_params)
+            search_scraper.urls = portal.urls
+            search_scraper.start(mode="max", leased=True)
+            process_scraper = STF_async.AsyncProcessScraper(self.db_params)
+            process_scraper.urls = portal.urls
+            assert process_scraper.start(leased=True)
+            found = [id_stf for id_stf in range(1, 13)
+                     if portal.has_processes(id_stf)]
+
+        with pg.connect(**self.db_params) as conn, conn.cursor() as curs:
+            curs.execute("SELECT DISTINCT id_stf FROM stf_data ORDER BY 1;")
+            assert [row[0] for row in curs.fetchall()] == found
+            curs.execute(cfg["sql"]["data"]["select"]["incomplete"])
+            assert curs.fetchall() == []
+
+
+class TestRefresh:
+    """Test refreshing complete processes against the local mock portal."""
+
+    db_params = cfg["testing"]["db_params"]
+
+    def test_refresh(self):
+        """Only stale processes are checked and only changes are written."""
+        with pg.connect(**self.db_params) as conn, conn.cursor() as curs:
+            curs.execute(cfg["testing"]["sql"]["drop_all"])
+            conn.commit()
+
+        def dates(curs):
+            curs.execute("""SELECT incidente, scrap_date FROM stf_data
+                ORDER BY incidente""")
+            return dict(curs.fetchall())
+
+        today = datetime.today().date()
+        old = date(2000, 1, 1)
+        with MockPortal() as portal, \
+                pg.connect(**self.db_params) as conn, conn.cursor() as curs:
+            search_scraper = STF.SearchScraper(self.db_params)
+            search_scraper.urls = portal.urls
+            search_scraper.step = 2
+            search_scraper.start(mode="max")
+            process_scraper = STF.ProcessScraper(self.db_params)
+            process_scraper.urls = portal.urls
+            process_scraper.start()
+            curs.execute("SELECT partes FROM stf_data WHERE incidente = 10")
+            partes = curs.fetchone()[0]
+
+            # Recently scraped processes are not refreshed
+            assert process_scraper.refresh()
+            assert portal.hits["detalhe"] == 8
+
+            # Unknown tabs are written with their hashes and validators
+            curs.execute("UPDATE stf_data SET scrap_date = %s", (old,))
+            conn.commit()
+            assert process_scraper.refresh()
+            assert set(dates(curs).values()) == {today}
+            curs.execute("SELECT partes FROM stf_data WHERE incidente = 10")
+            assert curs.fetchone()[0] == partes
+            curs.execute("""SELECT COUNT(*) FROM stf_tab_state
+                WHERE etag IS NOT NULL AND checked = %s""", (today,))
+            assert curs.fetchone()[0] == 8 * 3
+
+            # Unchanged pages are not written
+            curs.execute("UPDATE stf_data SET scrap_date = %s", (old,))
+            curs.execute("UPDATE stf_tab_state SET checked = %s", (old,))
+            conn.commit()
+            assert process_scraper.refresh()
+            assert portal.not_modified == 8 * 3
+            assert set(dates(curs).values()) == {old}
+
+            # Changed values are written, without the other tabs
+            curs.execute("""UPDATE stf_tab_state
+                SET checked = %s, hash = 'outdated', etag = NULL
+                WHERE incidente = 10 AND tab = 'infos'""", (old,))
+            conn.commit()
+            assert process_scraper.refresh()
+            assert portal.not_modified == 8 * 3 + 2
+            assert dates(curs)[10] == today
+            assert list(dates(curs).values()).count(old) == 7
+
+    def test_refresh_failures(self, monkeypatch):
+        """Processes failing to refresh are journaled and left as they were."""
+        monkeypatch.setitem(funcs.cfg["requests"]["retries"], "total", 0)
+        with pg.connect(**self.db_params) as conn, conn.cursor() as curs:
+            curs.execute(cfg["testing"]["sql"]["drop_all"])
+            conn.commit()
+
+        old = date(2000, 1, 1)
+        with MockPortal() as portal, \
+                pg.connect(**self.db_params) as conn, conn.cursor() as curs:
+            search_scraper = STF.SearchScraper(self.db_params)
+            search_scraper.urls = portal.urls
+            search_scraper.step = 2
+            search_scraper.start(mode="max")
+            process_scraper = STF.ProcessScraper(self.db_params)
+            process_scraper.urls = portal.urls
+            process_scraper.start()
+            curs.execute("UPDATE stf_data SET scrap_date = %s", (old,))
+            conn.commit()
+
+            portal.error_rate = 1
+            assert process_scraper.refresh()
+            curs.execute("SELECT DISTINCT scrap_date FROM stf_data;")
+            assert curs.fetchall() == [(old,)]
+            curs.execute("SELECT COUNT(*) FROM stf_tab_state;")
+            assert curs.fetchone()[0] == 0
+            curs.execute("SELECT kind, COUNT(*) FROM stf_failures "
+                         "GROUP BY kind;")
+            assert curs.fetchall() == [("refresh", 8)]
+
+            # Failed processes wait 'retry_delay' before the next try
+            hits = portal.hits["detalhe"]
+            assert process_scraper.refresh()
+            assert portal.hits["detalhe"] == hits
+
+            # And are no longer tried after 'max_attempts' failures
+            monkeypatch.setitem(STF.cfg["failures"], "retry_delay", 0)
+            monkeypatch.setitem(STF.cfg["failures"], "max_attempts", 2)
+            assert process_scraper.refresh()
+            curs.execute("SELECT DISTINCT attempts FROM stf_failures;")
+            assert curs.fetchall() == [(2,)]
+
+            # Refreshed processes drop their failures
+            curs.execute("""UPDATE stf_failures SET attempts = 1
+                WHERE id = 10;""")
+            conn.commit()
+            portal.error_rate = 0
+            hits = portal.hits["detalhe"]
+            assert process_scraper.refresh()
+            assert portal.hits["detalhe"] == hits + 1
+            curs.execute("SELECT id FROM stf_failures WHERE id = 10;")
+            assert curs.fetchall() == []
+            curs.execute("SELECT COUNT(*) FROM stf_failures;")
+            assert curs.fetchone()[0] == 7
@@ -0,0 +1,108 @@
+"""On-disk store of raw portal responses."""
+from typing import List, Literal, Optional, Tuple
+from urllib.parse import urlsplit
+import hashlib
+import logging
+import os
+import threading
+import zlib
+
+CacheMode = Literal["disabled", "record", "replay"]
+
+
+class CacheMiss(Exception):
+    """Raised on ``replay`` mode when a page is not in the cache."""
+
+
+class ResponseCache:
+    """Compressed raw responses keyed by URL, evicted by least recent use.
+
+    There are three modes:
+    ``disabled`` does not touch the disk,
+    ``record`` fetches every page and stores its raw bytes, and
+    ``replay`` reads pages only from the cache, so scrapers can re-parse
+    stored pages without reaching the portal.
+
+    Keys ignore scheme and host, so pages recorded from the portal can be
+    replayed behind any other address. Once the stored bytes exceed
+    ``max_bytes`` the least recently read pages are removed until only 90% of
+    it is used.
+    """
+
+    def __init__(self, path: str, max_bytes: int,
+                 mode: CacheMode = "record") -> None:
+        """Create the cache directory and measure its contents."""
+        self.path: str = path
+        self.max_bytes: int = max_bytes
+        self.mode: CacheMode = mode
+        self.size: int = 0
+        self._lock = threading.Lock()
+        if self.mode != "disabled":
+            os.makedirs(self.path, exist_ok=True)
+            self.size = sum(os.path.getsize(file) for file in self._files())
+
+    @staticmethod
+    def key(url: str) -> str:
+        """Hash the path and query of ``url``."""
+        parts = urlsplit(url)
+        return hashlib.sha1(
+            f"{parts.path}?{parts.query}".encode("utf-8")).hexdigest()
+
+    def _file(self, key: str) -> str:
+        """Return the file of a key, spread over 256 directories."""
+        return os.path.join(self.path, key[:2], f"{key}.z")
+
+    def _files(self) -> List[str]:
+        """List all stored files."""
+        return [entry.path
+                for folder in os.scandir(self.path) if folder.is_dir()
+                for entry in os.scandir(folder.path)
+                if entry.name.endswith(".z")]
+
+    def get(self, url: str) -> Optional[bytes]:
+        """Return the raw response of ``url`` or ``None`` if not stored."""
+        file: str = self._file(self.key(url))
+        try:
+            with open(file, "rb") as stored:
+                compressed: bytes = stored.read()
+            # Mark as recently used
+            os.utime(file)
+        except FileNotFoundError:
+            return None
+        return zlib.decompress(compressed)
+
+    def put(self, url: str, content: bytes) -> None:
+        """Store the raw response of ``url``, evicting old pages if needed."""
+        file: str = self._file(self.key(url))
+        os.makedirs(os.path.dirname(file), exist_ok=True)
+        compressed: bytes = zlib.compress(content)
+        # Write to a temporary file first so readers never see partial pages
+        tmp_file: str = f"{file}.{threading.get_ident()}.tmp"
+        with open(tmp_file, "wb") as stored:
+            stored.write(compressed)
+        with self._lock:
+            try:
+                self.size -= os.path.getsize(file)
+            except FileNotFoundError:
+                pass
+            os.replace(tmp_file, file)
+            self.size += len(compressed)
+            if self.size > self.max_bytes:
+                self._evict()
+
+    def _evict(self) -> None:
+        """Remove least recently used pages down to 90% of ``max_bytes``."""
+        files: List[Tuple[float, int, str]] = []
+        for file in self._files():
+            stat = os.stat(file)
+            files.append((stat.st_mtime, stat.st_size, file))
+        files.sort()
+        target: float = self.max_bytes * 0.9
+        removed: int = 0
+        for _, size, file in files:
+            if self.size <= target:
+                break
+            os.remove(file)
+            self.size -= size
+            removed += 1
+        logging.info(f"Evicted {removed} pages from response cache")
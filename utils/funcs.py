@@ -1,16 +1,345 @@
 """Utility functions."""
+from concurrent.futures import Executor, FIRST_COMPLETED, Future, wait
+from typing import (Any, Callable, Dict, Iterable, Iterator, List, Literal,
+                    NamedTuple, Optional, Set, Tuple)
+import logging
+import threading
+import time
+import lxml.etree
 import lxml.html
 import requests
+from requests.adapters import HTTPAdapter
 import yaml
+from utils.cache import CacheMiss, ResponseCache
+from utils.governor import backoff, Governor
+from utils.metrics import metrics
 
 with open("utils/config.yml") as ymlfile:
     cfg = yaml.safe_load(ymlfile)
 
+_session: Optional[requests.Session] = None
+_session_lock = threading.Lock()
+_cache: Optional[ResponseCache] = None
+_cache_lock = threading.Lock()
+_governors: Dict[str, Governor] = {}
+_governors_lock = threading.Lock()
 
-def requester(url: str) -> lxml.html.HtmlElement:
-    """Do request and return decoded HTML response."""
-    res: requests.models.Response = requests.get(
-        url, headers=cfg["requests"]["headers"],
-        timeout=cfg["requests"]["timeout"])
-    res_decoded: str = res.text.encode("iso-8859-1").decode("utf-8")
-    return lxml.html.fromstring(res_decoded)
+Endpoint = Literal["search", "details"]
+
+
+# The portal does not declare a charset but serves UTF-8, so pages are parsed
+# from bytes without being decoded first
+UTF8_PARSER = lxml.html.HTMLParser(encoding="utf-8")
+
+
+def build_session() -> requests.Session:
+    """Build a keep-alive session with a connection pool.
+
+    The pool keeps up to ``max_workers`` connections per host alive for each
+    page a worker may fetch at once, so every request can reuse a TCP
+    connection to the portal. Retries are made by ``fetch``.
+    """
+    adapter: HTTPAdapter = HTTPAdapter(
+        pool_connections=cfg["requests"]["pool"]["hosts"],
+        pool_maxsize=cfg["threads"]["max_workers"]
+        * cfg["requests"]["pool"]["per_worker"],
+        max_retries=0)
+    session: requests.Session = requests.Session()
+    session.headers.update(cfg["requests"]["headers"])
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    return session
+
+
+def get_session() -> requests.Session:
+    """Return the session shared by all worker threads."""
+    global _session
+    if _session is None:
+        with _session_lock:
+            if _session is None:
+                _session = build_session()
+    return _session
+
+
+def bounded_map(executor: Executor, fn: Callable, items: Iterable,
+                max_pending: int) -> Iterator[Any]:
+    """Run ``fn`` on ``items`` and yield results as they finish.
+
+    Unlike ``executor.map`` or ``as_completed``, items are pulled only when
+    fewer than ``max_pending`` are waiting, so large or endless iterables are
+    never loaded at once.
+    """
+    items = iter(items)
+    pending: Set[Future] = set()
+    while True:
+        for item in items:
+            pending.add(executor.submit(fn, item))
+            if len(pending) >= max_pending:
+                break
+        if not pending:
+            return
+        done, pending = wait(pending, return_when=FIRST_COMPLETED)
+        for future in done:
+            yield future.result()
+
+
+def get_governor(endpoint: Endpoint) -> Governor:
+    """Return the governor of an endpoint set on ``utils/config.yml``."""
+    with _governors_lock:
+        if endpoint not in _governors:
+            _governors[endpoint] = Governor(**cfg["governor"][endpoint])
+        return _governors[endpoint]
+
+
+def retry_delay(attempt: int) -> Optional[float]:
+    """Return the wait before retrying ``attempt`` or ``None`` to give up."""
+    retries: dict = cfg["requests"]["retries"]
+    if attempt >= retries["total"]:
+        return None
+    return backoff(attempt, retries["backoff_base"], retries["backoff_cap"])
+
+
+def get_cache() -> ResponseCache:
+    """Return the response cache set on ``utils/config.yml``."""
+    global _cache
+    if _cache is None:
+        with _cache_lock:
+            if _cache is None:
+                _cache = ResponseCache(cfg["cache"]["path"],
+                                       cfg["cache"]["max_bytes"],
+                                       cfg["cache"]["mode"])
+    return _cache
+
+
+def set_cache(cache: ResponseCache) -> None:
+    """Replace the response cache used by all requesters."""
+    global _cache
+    _cache = cache
+
+
+def cached(url: str) -> Optional[bytes]:
+    """Return the stored page on ``replay`` mode, ``None`` otherwise.
+
+    Raises ``CacheMiss`` when replaying a page that was never stored.
+    """
+    cache: ResponseCache = get_cache()
+    if cache.mode != "replay":
+        return None
+    content: Optional[bytes] = cache.get(url)
+    if content is None:
+        metrics.inc("cache_misses_total")
+        raise CacheMiss(url)
+    metrics.inc("cache_hits_total")
+    return content
+
+
+def store(url: str, content: bytes) -> None:
+    """Store a fetched page on ``record`` mode."""
+    cache: ResponseCache = get_cache()
+    if cache.mode == "record":
+        cache.put(url, content)
+
+
+def parse_html(content: bytes) -> lxml.html.HtmlElement:
+    """Parse a whole page from its raw bytes."""
+    with metrics.timer("parse_seconds"):
+        return lxml.html.document_fromstring(content, parser=UTF8_PARSER)
+
+
+class PageParser:
+    """Parse a page while its body streams in.
+
+    Chunks of raw bytes are fed to an lxml parser as they arrive, so pages
+    are never decoded to text nor joined. With ``keep`` the chunks are also
+    kept, to be stored on the response cache.
+    """
+
+    def __init__(self, keep: bool = False) -> None:
+        """Start a parser for a single page."""
+        self._parser = lxml.html.HTMLParser(encoding="utf-8")
+        self.chunks: Optional[List[bytes]] = [] if keep else None
+        self.size: int = 0
+        self._elapsed: float = 0.0
+
+    def feed(self, chunk: bytes) -> None:
+        """Parse a chunk of the page."""
+        started: float = time.perf_counter()
+        self._parser.feed(chunk)
+        self._elapsed += time.perf_counter() - started
+        self.size += len(chunk)
+        if self.chunks is not None:
+            self.chunks.append(chunk)
+
+    @property
+    def content(self) -> bytes:
+        """Return the kept page."""
+        return b"".join(self.chunks)
+
+    def close(self) -> lxml.html.HtmlElement:
+        """Finish parsing and return the page's root.
+
+        Raises ``ParserError`` on empty pages, as ``parse_html`` does.
+        """
+        if not self.size:
+            raise lxml.etree.ParserError("Document is empty")
+        started: float = time.perf_counter()
+        root: Optional[lxml.html.HtmlElement] = self._parser.close()
+        metrics.observe("parse_seconds",
+                        self._elapsed + time.perf_counter() - started)
+        if root is None:
+            raise lxml.etree.ParserError("Document is empty")
+        return root
+
+
+def read_page(chunks: Iterable[bytes], keep: bool = False) -> PageParser:
+    """Feed all ``chunks`` of a page to a new ``PageParser``."""
+    page: PageParser = PageParser(keep)
+    for chunk in chunks:
+        page.feed(chunk)
+    return page
+
+
+def record_response(endpoint: Endpoint, latency: float,
+                    status: str, size: int = 0) -> None:
+    """Record the latency, status and size of a request."""
+    metrics.observe("http_request_seconds", latency, endpoint=endpoint)
+    metrics.inc("http_requests_total", endpoint=endpoint, status=status)
+    metrics.inc("http_response_bytes_total", size, endpoint=endpoint)
+
+
+def join_body(res: requests.models.Response,
+              chunks: Iterable[bytes]) -> bytes:
+    """Return a whole response body."""
+    return b"".join(chunks)
+
+
+def fetch(url: str, endpoint: Endpoint,
+          consume: Callable[[requests.models.Response, Iterable[bytes]],
+                            Any] = join_body,
+          headers: Optional[dict] = None) -> Any:
+    """Request ``url`` under its endpoint's governor and consume its body.
+
+    ``consume`` is called with the response and its body streamed in chunks
+    of ``requests.chunk_size`` bytes, and its result is returned. By default
+    the chunks are joined. ``headers`` are sent along the session's.
+
+    Timeouts, connection errors and ``retries.status_forcelist`` answers are
+    retried with exponential backoff and jitter. The last error is raised
+    once ``retries.total`` retries are spent. Other error statuses are raised
+    at once.
+    """
+    governor: Governor = get_governor(endpoint)
+    attempt: int = 0
+    received: List[int] = [0]
+
+    def chunks(res: requests.models.Response) -> Iterator[bytes]:
+        for chunk in res.iter_content(cfg["requests"]["chunk_size"]):
+            received[0] += len(chunk)
+            yield chunk
+
+    while True:
+        governor.acquire()
+        started: float = time.monotonic()
+        received[0] = 0
+        try:
+            with get_session().get(url, headers=headers, stream=True,
+                                   timeout=cfg["requests"]["timeout"]) as res:
+                failed: bool = res.status_code \
+                    in cfg["requests"]["retries"]["status_forcelist"]
+                if res.ok:
+                    body: Any = consume(res, chunks(res))
+        except (requests.ConnectionError, requests.Timeout,
+                requests.exceptions.ChunkedEncodingError) as error:
+            latency: float = time.monotonic() - started
+            governor.release(latency, ok=False)
+            record_response(endpoint, latency, type(error).__name__,
+                            received[0])
+            failure: str = repr(error)
+            delay: Optional[float] = retry_delay(attempt)
+            if delay is None:
+                metrics.inc("http_errors_total", endpoint=endpoint)
+                raise
+        except Exception:
+            # Raised by 'consume' on a page fully received
+            governor.release(time.monotonic() - started, ok=True)
+            raise
+        else:
+            latency = time.monotonic() - started
+            governor.release(latency, ok=not failed)
+            record_response(endpoint, latency, str(res.status_code),
+                            received[0])
+            if not failed:
+                res.raise_for_status()
+                return body
+            failure = f"status {res.status_code}"
+            delay = retry_delay(attempt)
+            if delay is None:
+                metrics.inc("http_errors_total", endpoint=endpoint)
+                res.raise_for_status()
+        metrics.inc("http_retries_total", endpoint=endpoint)
+        logging.warning(f"Retrying {url} in {delay:.1f}s after {failure}")
+        time.sleep(delay)
+        attempt += 1
+
+
+def requester(url: str, endpoint: Endpoint = "search"
+              ) -> lxml.html.HtmlElement:
+    """Do request and return the parsed HTML response.
+
+    Pages are parsed as they stream in. They are read from and stored to the
+    response cache depending on its mode.
+    """
+    content: Optional[bytes] = cached(url)
+    if content is not None:
+        return parse_html(content)
+    keep: bool = get_cache().mode == "record"
+    page: PageParser = fetch(url, endpoint,
+                             lambda res, chunks: read_page(chunks, keep))
+    if keep:
+        store(url, page.content)
+    return page.close()
+
+
+class Validated(NamedTuple):
+    """Page of a conditional request and its validators.
+
+    ``html`` is ``None`` when the page was not modified.
+    """
+
+    html: Optional[lxml.html.HtmlElement]
+    etag: Optional[str]
+    last_modified: Optional[str]
+
+
+def conditional_requester(url: str, endpoint: Endpoint = "details",
+                          etag: Optional[str] = None,
+                          last_modified: Optional[str] = None) -> Validated:
+    """Request a page unless it is unchanged since it was last validated.
+
+    ``etag`` and ``last_modified`` are the validators of the last response,
+    sent as ``If-None-Match`` and ``If-Modified-Since``.
+    """
+    content: Optional[bytes] = cached(url)
+    if content is not None:
+        return Validated(parse_html(content), None, None)
+    headers: dict = {}
+    if etag is not None:
+        headers["If-None-Match"] = etag
+    if last_modified is not None:
+        headers["If-Modified-Since"] = last_modified
+    keep: bool = get_cache().mode == "record"
+
+    def consume(res: requests.models.Response, chunks: Iterable[bytes]
+                ) -> Tuple[Optional[PageParser], Optional[str], Optional[str]]:
+        page: Optional[PageParser] = None
+        if res.status_code != 304:
+            page = read_page(chunks, keep)
+        return page, res.headers.get("ETag"), res.headers.get("Last-Modified")
+
+    page, etag, last_modified = fetch(url, endpoint, consume, headers)
+    if page is None:
+        metrics.inc("http_not_modified_total", endpoint=endpoint)
+        return Validated(None, etag, last_modified)
+    if keep:
+        store(url, page.content)
+    return Validated(page.close(), etag, last_modified)
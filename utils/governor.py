@@ -0,0 +1,126 @@
+"""Client-side rate and concurrency control for the STF portal."""
+from collections import deque
+from typing import Deque, Optional, Tuple
+import asyncio
+import random
+import threading
+import time
+
+
+class Governor:
+    """Limit requests to an endpoint by rate and adaptive concurrency.
+
+    A token bucket keeps requests under ``rate`` per second, with bursts of
+    up to ``burst`` requests. The number of requests in flight is capped by a
+    limit adjusted by AIMD: it grows by about one request per window of
+    successful answers faster than ``target_latency`` and is halved on
+    errors, throttling or slow answers, at most once per ``target_latency``
+    seconds.
+
+    Call ``acquire`` (or ``acquire_async``) before each request and
+    ``release`` with its outcome after it. Coroutines waiting for a slot are
+    woken by ``release`` in arrival order, one per slot freed, from any
+    thread or event loop.
+    """
+
+    def __init__(self, rate: float, burst: int, min_concurrency: int,
+                 max_concurrency: int, target_latency: float) -> None:
+        """Start at the maximum concurrency with a full bucket."""
+        self.rate: float = rate
+        self.burst: int = burst
+        self.min_concurrency: int = min_concurrency
+        self.max_concurrency: int = max_concurrency
+        self.target_latency: float = target_latency
+        self.limit: float = max_concurrency
+        self.in_flight: int = 0
+        self.tokens: float = burst
+        self._refilled: float = time.monotonic()
+        self._decreased: float = 0.0
+        self._cond = threading.Condition()
+        self._waiters: Deque[Tuple[asyncio.AbstractEventLoop,
+                                   asyncio.Future]] = deque()
+
+    def _try_acquire(self) -> Optional[float]:
+        """Take a slot and a token if possible.
+
+        Returns ``0`` on success, the seconds until the next token or ``None``
+        when waiting for a request to finish.
+        """
+        now: float = time.monotonic()
+        self.tokens = min(self.burst,
+                          self.tokens + (now - self._refilled) * self.rate)
+        self._refilled = now
+        if self.in_flight >= int(self.limit):
+            return None
+        if self.tokens < 1:
+            return (1 - self.tokens) / self.rate
+        self.tokens -= 1
+        self.in_flight += 1
+        return 0
+
+    def acquire(self) -> None:
+        """Wait until a request may be sent."""
+        with self._cond:
+            while (wait := self._try_acquire()) != 0:
+                self._cond.wait(wait)
+
+    async def acquire_async(self) -> None:
+        """Wait on the event loop until a request may be sent."""
+        loop: asyncio.AbstractEventLoop = asyncio.get_running_loop()
+        while True:
+            with self._cond:
+                wait: Optional[float] = self._try_acquire()
+                if wait is None:
+                    waiter: asyncio.Future = loop.create_future()
+                    self._waiters.append((loop, waiter))
+            if wait == 0:
+                return
+            if wait is not None:
+                await asyncio.sleep(wait)
+                continue
+            try:
+                await waiter
+            except asyncio.CancelledError:
+                with self._cond:
+                    try:
+                        self._waiters.remove((loop, waiter))
+                    except ValueError:
+                        # Already woken, so the slot goes to the next one
+                        self._wake(1)
+                raise
+
+    def _wake(self, slots: int) -> None:
+        """Wake up to ``slots`` waiting coroutines, the oldest first."""
+        while slots > 0 and self._waiters:
+            loop, waiter = self._waiters.popleft()
+            try:
+                loop.call_soon_threadsafe(_resolve, waiter)
+            except RuntimeError:
+                # The loop is closed
+                continue
+            slots -= 1
+
+    def release(self, latency: float, ok: bool) -> None:
+        """Free a slot and adjust the concurrency limit."""
+        with self._cond:
+            self.in_flight -= 1
+            now: float = time.monotonic()
+            if ok and latency <= self.target_latency:
+                self.limit = min(self.max_concurrency,
+                                 self.limit + 1 / self.limit)
+            elif now - self._decreased > self.target_latency:
+                self.limit = max(self.min_concurrency, self.limit / 2)
+                self._decreased = now
+            self._cond.notify_all()
+            self._wake(int(self.limit) - self.in_flight)
+
+
+def _resolve(waiter: asyncio.Future) -> None:
+    """Wake a coroutine waiting for a slot, unless it was cancelled."""
+    if not waiter.done():
+        waiter.set_result(None)
+
+
+def backoff(attempt: int, base: float, cap: float) -> float:
+    """Return a delay with full jitter for a retry ``attempt`` from ``0``."""
+    return random.uniform(0, min(cap, base * 2 ** attempt))
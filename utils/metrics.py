@@ -0,0 +1,281 @@
+"""Latency and throughput metrics of scraping stages.
+
+Stages record counters and latency histograms on the shared ``metrics``
+registry. ``reporting`` exports them while a scraper runs, as set on the
+``metrics`` section of ``utils/config.yml``: a Prometheus text endpoint, a
+JSON snapshot file and a sampling profiler of all threads.
+"""
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Dict, Generator, List, Optional, Tuple
+import bisect
+import json
+import os
+import sys
+import threading
+import time
+import yaml
+
+with open("utils/config.yml") as ymlfile:
+    cfg = yaml.safe_load(ymlfile)
+
+# Upper bounds of histogram buckets, in seconds
+BUCKETS: Tuple[float, ...] = (
+    0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5,
+    5, 10, 30, 60)
+
+Key = Tuple[str, Tuple[Tuple[str, str], ...]]
+
+
+class Histogram:
+    """Count observations in the fixed ``BUCKETS``."""
+
+    __slots__ = ("counts", "count", "sum")
+
+    def __init__(self) -> None:
+        """Start empty, with a last bucket for values past all bounds."""
+        self.counts: List[int] = [0] * (len(BUCKETS) + 1)
+        self.count: int = 0
+        self.sum: float = 0.0
+
+    def observe(self, value: float) -> None:
+        """Add a value to its bucket."""
+        self.counts[bisect.bisect_left(BUCKETS, value)] += 1
+        self.count += 1
+        self.sum += value
+
+    def quantile(self, q: float) -> float:
+        """Estimate a quantile by interpolating within its bucket."""
+        rank: float = q * self.count
+        seen: int = 0
+        for bucket, count in enumerate(self.counts):
+            if count and seen + count >= rank:
+                lower: float = BUCKETS[bucket - 1] if bucket else 0.0
+                if bucket == len(BUCKETS):
+                    return lower
+                return lower + (BUCKETS[bucket] - lower) \
+                    * (rank - seen) / count
+            seen += count
+        return 0.0
+
+
+def _render(key: Key, suffix: str = "", **extra: str) -> str:
+    """Render a metric key on the Prometheus text format."""
+    name, labels = key
+    pairs: List[str] = [f'{label}="{value}"'
+                        for label, value in labels + tuple(extra.items())]
+    return f"{name}{suffix}" + (f"{{{','.join(pairs)}}}" if pairs else "")
+
+
+class Metrics:
+    """Thread safe registry of counters and latency histograms.
+
+    Metrics are created when first recorded and told apart by their name and
+    labels.
+    """
+
+    def __init__(self) -> None:
+        """Start an empty registry."""
+        self.counters: Dict[Key, float] = {}
+        self.histograms: Dict[Key, Histogram] = {}
+        self.started: float = time.monotonic()
+        self._lock = threading.Lock()
+
+    def inc(self, name: str, amount: float = 1, **labels: str) -> None:
+        """Add ``amount`` to a counter."""
+        key: Key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self.counters[key] = self.counters.get(key, 0) + amount
+
+    def observe(self, name: str, seconds: float, **labels: str) -> None:
+        """Record a latency on a histogram."""
+        key: Key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            if key not in self.histograms:
+                self.histograms[key] = Histogram()
+            self.histograms[key].observe(seconds)
+
+    @contextmanager
+    def timer(self, name: str, **labels: str) -> Generator[None, None, None]:
+        """Record how long the block takes, even if it raises."""
+        started: float = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - started, **labels)
+
+    def reset(self) -> None:
+        """Drop all metrics and restart the uptime."""
+        with self._lock:
+            self.counters, self.histograms = {}, {}
+            self.started = time.monotonic()
+
+    def snapshot(self) -> dict:
+        """Return counters with their rates and histogram summaries."""
+        with self._lock:
+            uptime: float = time.monotonic() - self.started
+            return {
+                "uptime": uptime,
+                "counters": {
+                    _render(key): {"value": value,
+                                   "rate": value / uptime if uptime else 0.0}
+                    for key, value in self.counters.items()},
+                "histograms": {
+                    _render(key): {"count": histogram.count,
+                                   "sum": histogram.sum,
+                                   "p50": histogram.quantile(0.5),
+                                   "p99": histogram.quantile(0.99)}
+                    for key, histogram in self.histograms.items()}}
+
+    def prometheus(self) -> str:
+        """Return all metrics on the Prometheus text format."""
+        lines: List[str] = []
+        typed: str = ""
+        with self._lock:
+            for key, value in sorted(self.counters.items()):
+                if key[0] != typed:
+                    typed = key[0]
+                    lines.append(f"# TYPE {typed} counter")
+                lines.append(f"{_render(key)} {value}")
+            for key, histogram in sorted(self.histograms.items(),
+                                         key=lambda item: item[0]):
+                if key[0] != typed:
+                    typed = key[0]
+                    lines.append(f"# TYPE {typed} histogram")
+                cumulative: int = 0
+                for bound, count in zip(BUCKETS + ("+Inf",),
+                                        histogram.counts):
+                    cumulative += count
+                    lines.append(
+                        f"{_render(key, '_bucket', le=str(bound))} "
+                        f"{cumulative}")
+                lines.append(f"{_render(key, '_sum')} {histogram.sum}")
+                lines.append(f"{_render(key, '_count')} {histogram.count}")
+        return "\n".join(lines) + "\n"
+
+
+metrics: Metrics = Metrics()
+
+
+def serve(port: int) -> ThreadingHTTPServer:
+    """Serve ``/metrics`` as Prometheus text and ``/metrics.json``.
+
+    The server runs on a background thread until ``shutdown`` is called. Use
+    port ``0`` for any free port.
+    """
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self) -> None:
+            if self.path == "/metrics":
+                body: bytes = metrics.prometheus().encode("utf-8")
+                content_type: str = "text/plain; version=0.0.4"
+            elif self.path == "/metrics.json":
+                body = json.dumps(metrics.snapshot()).encode("utf-8")
+                content_type = "application/json"
+            else:
+                self.send_error(404)
+                return
+            self.send_response(200)
+            self.send_header("Content-Type", content_type)
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args) -> None:
+            pass
+
+    server: ThreadingHTTPServer = ThreadingHTTPServer(("", port), Handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+class Reporter(threading.Thread):
+    """Run ``report`` every ``interval`` seconds and once more on ``stop``."""
+
+    def __init__(self, report, interval: float) -> None:
+        """Initialize a daemon thread."""
+        super().__init__(daemon=True)
+        self.report = report
+        self.interval: float = interval
+        self._stopped = threading.Event()
+
+    def run(self) -> None:
+        """Report until stopped."""
+        while not self._stopped.wait(self.interval):
+            self.report()
+
+    def stop(self) -> None:
+        """Stop the thread and report a last time."""
+        self._stopped.set()
+        self.join()
+        self.report()
+
+
+def write_snapshot(path: str) -> None:
+    """Write the metrics snapshot to ``path`` as JSON."""
+    with open(f"{path}.tmp", "w") as snapshot:
+        json.dump(metrics.snapshot(), snapshot, indent=2)
+    os.replace(f"{path}.tmp", path)
+
+
+class Sampler(Reporter):
+    """Sample the stacks of all threads, a low overhead profiler.
+
+    ``cProfile`` only sees the thread that enables it, while scrapers work on
+    many. Stacks are counted on the collapsed format read by
+    ``flamegraph.pl`` and speedscope and written to ``path`` on ``stop``.
+    """
+
+    def __init__(self, path: str, interval: float) -> None:
+        """Initialize empty stack counts."""
+        super().__init__(self.sample, interval)
+        self.path: str = path
+        self.stacks: Dict[str, int] = {}
+
+    def sample(self) -> None:
+        """Count the current stack of every other thread."""
+        for thread_id, frame in sys._current_frames().items():
+            if thread_id == self.ident:
+                continue
+            calls: List[str] = []
+            while frame is not None:
+                code = frame.f_code
+                calls.append(
+                    f"{os.path.basename(code.co_filename)}:{code.co_name}")
+                frame = frame.f_back
+            stack: str = ";".join(reversed(calls))
+            self.stacks[stack] = self.stacks.get(stack, 0) + 1
+
+    def stop(self) -> None:
+        """Stop sampling and write stack counts."""
+        super().stop()
+        with open(self.path, "w") as profile:
+            for stack, count in sorted(self.stacks.items()):
+                profile.write(f"{stack} {count}\n")
+
+
+@contextmanager
+def reporting() -> Generator[None, None, None]:
+    """Export metrics as set on ``metrics`` while the block runs."""
+    settings: dict = cfg["metrics"]
+    server: Optional[ThreadingHTTPServer] = None
+    reporters: List[Reporter] = []
+    if settings["port"] is not None:
+        server = serve(settings["port"])
+    if settings["snapshot"] is not None:
+        reporters.append(Reporter(
+            lambda: write_snapshot(settings["snapshot"]),
+            settings["interval"]))
+    if settings["profile"] is not None:
+        reporters.append(Sampler(settings["profile"],
+                                 settings["sample_interval"]))
+    for reporter in reporters:
+        reporter.start()
+    try:
+        yield
+    finally:
+        for reporter in reporters:
+            reporter.stop()
+        if server is not None:
+            server.shutdown()
+            server.server_close()
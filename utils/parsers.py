@@ -0,0 +1,198 @@
+"""Parsers for STF pages.
+
+Parsers receive already requested HTML and return the extracted values
+without touching the scrapers' state, so they can be shared by the threaded
+and asynchronous scrapers.
+
+All XPath expressions are compiled once, when this module is imported, and
+each page is walked a single time.
+"""
+from dataclasses import dataclass
+from datetime import date, datetime
+from typing import Callable, Dict, List, NamedTuple, Optional, Tuple
+import re
+import lxml.etree
+import lxml.html
+import yaml
+
+with open("utils/config.yml") as ymlfile:
+    cfg = yaml.safe_load(ymlfile)
+
+# Search page
+SEARCH_ROWS = lxml.etree.XPath("//table/tr")
+ROW_CELLS = lxml.etree.XPath("./td")
+MEIOS: Dict[str, int] = {"Físico": 1, "Eletrônico": 2}
+TIPOS: Dict[str, int] = {
+    "Público": 1, "Segredo de Justiça": 2, "Sigiloso": 3}
+
+# Details pages
+CLASSE_PROCESSO = lxml.etree.XPath(
+    cfg["xpath"]["process"]["classe_processo"])
+PARTES_LIST = lxml.etree.XPath(cfg["xpath"]["process"]["partes_list"])
+PARTE_TIPO = lxml.etree.XPath("./div[@class='detalhe-parte']/text()")
+PARTE_NOME = lxml.etree.XPath("./div[@class='nome-parte']/text()")
+ASSUNTOS = lxml.etree.XPath("//ul[@style='list-style:none;']/li/text()[1]")
+# First text of every tag, as labels such as 'Origem:' are kept there
+LABELS = lxml.etree.XPath("//*/text()[1][contains(., ':')]")
+VALUE = lxml.etree.XPath("string(./text()[1])")
+BLANKS = re.compile(r"[\n\t\s]*")
+
+
+class SearchRow(NamedTuple):
+    """Minimal process data listed on STF search pages."""
+
+    incidente: int
+    numero_unico: str
+    classe_processo_sigla: str
+    data_protocolo: date
+    meio_id: int
+    tipo_id: int
+
+
+def parse_search(search_html: lxml.html.HtmlElement,
+                 code: Optional[str] = None) -> List[SearchRow]:
+    """Parse search page rows, keeping only processes of ``code`` if given."""
+    rows: List[SearchRow] = []
+    for item in SEARCH_ROWS(search_html):
+        cells: List[lxml.html.HtmlElement] = ROW_CELLS(item)
+        link: lxml.html.HtmlElement = cells[0].find("a")
+        classe_processo_sigla: str = link.text.split(" ")[0]
+        # Only parse processes with given code
+        if code is not None and classe_processo_sigla != code:
+            continue
+
+        meio: str = cells[3].text
+        if meio not in MEIOS:
+            raise ValueError(f"Unknown 'meio':{meio}")
+        tipo: str = cells[4].text
+        if tipo not in TIPOS:
+            raise ValueError(f"Unknown 'tipo':{tipo}")
+
+        rows.append(SearchRow(
+            incidente=int(link.get("href").split("=")[1]),
+            numero_unico=cells[1].text.replace(".", "").replace("-", ""),
+            classe_processo_sigla=classe_processo_sigla,
+            data_protocolo=datetime.strptime(
+                cells[2].text, "%d/%m/%Y").date(),
+            meio_id=MEIOS[meio],
+            tipo_id=TIPOS[tipo]))
+    return rows
+
+
+@dataclass(frozen=True, slots=True)
+class ProcessDetails:
+    """Detailed data of a process, parsed from its three tabs."""
+
+    incidente: int
+    classe_processo: str
+    partes: Tuple[Tuple[str, str], ...]
+    assuntos: Tuple[str, ...]
+    orgao_origem: str
+    origem: str
+    numeros_origem: Tuple[str, ...]
+    data_protocolo: Optional[date]
+
+    def payload(self, scrap_date: date) -> tuple:
+        """Return values in the order of ``sql.data.update``."""
+        # Lists must be converted to strings before writing to DB for now
+        return (self.classe_processo, list(self.partes), list(self.assuntos),
+                self.orgao_origem, self.origem, list(self.numeros_origem),
+                scrap_date, self.incidente)
+
+
+def parse_details(incidente: int,
+                  processo_html: lxml.html.HtmlElement,
+                  partes_html: lxml.html.HtmlElement,
+                  detalhes_html: lxml.html.HtmlElement) -> ProcessDetails:
+    """Parse the three tabs of a process."""
+    details: dict = parse_incident(detalhes_html)
+    return ProcessDetails(
+        incidente=incidente,
+        classe_processo=parse_process(processo_html),
+        partes=tuple(parse_parts(partes_html)),
+        assuntos=tuple(details["assuntos"]),
+        orgao_origem=details["orgao_origem"],
+        origem=details["origem"],
+        numeros_origem=tuple(details["numeros_origem"]),
+        data_protocolo=details["data_protocolo"])
+
+
+def parse_process(processo_html: lxml.html.HtmlElement) -> str:
+    """Parse 'process' page."""
+    # Dados gerais
+    classe_processo: List[str] = CLASSE_PROCESSO(processo_html)
+    return classe_processo[0].strip() if len(classe_processo) else ""
+
+
+def parse_parts(partes_html: lxml.html.HtmlElement) -> List[Tuple[str, str]]:
+    """Parse 'parts' page."""
+    # Partes do processo
+    return [(PARTE_TIPO(parte)[0], PARTE_NOME(parte)[0])
+            for parte in PARTES_LIST(partes_html)]
+
+
+def _protocol_date(value: str) -> Optional[date]:
+    """Parse 'Data de Protocolo:' values."""
+    value = value.strip()
+    return datetime.strptime(value, "%d/%m/%Y").date() if value else None
+
+
+def _origin_numbers(value: str) -> List[str]:
+    """Parse 'Número de Origem:' values."""
+    numeros_origem: List[str] = BLANKS.sub("", value).split(",")
+    return numeros_origem if len(numeros_origem[0]) else []
+
+
+# Label of each field on the 'incident' page and how to parse its value
+INCIDENT_FIELDS: Dict[str, Tuple[str, Callable[[str], object]]] = {
+    "Data de Protocolo:": ("data_protocolo", _protocol_date),
+    "Órgão de Origem:": ("orgao_origem", str.strip),
+    "Origem:": ("origem", str.strip),
+    "Número de Origem:": ("numeros_origem", _origin_numbers),
+}
+
+
+def parse_incident(detalhes_html: lxml.html.HtmlElement) -> dict:
+    """Parse 'incident' page.
+
+    Returns a dict with ``assuntos``, ``data_protocolo``, ``orgao_origem``,
+    ``origem`` and ``numeros_origem``. Fields missing from the page keep
+    empty values.
+    """
+    # Detalhes do processo
+    details: dict = {"assuntos": [], "data_protocolo": None,
+                     "orgao_origem": "", "origem": "", "numeros_origem": []}
+    for assunto in ASSUNTOS(detalhes_html):
+        details["assuntos"].append("; ".join(
+            item.strip() for item in assunto.replace("||", "|").split("|")))
+
+    # A positional approach could be used but the tags positions might not
+    # be the same across all processes, so values are found by their labels.
+    for label in LABELS(detalhes_html):
+        field: Optional[Tuple[str, Callable[[str], object]]] = \
+            INCIDENT_FIELDS.get(label.strip())
+        if field is None:
+            continue
+        tag: lxml.html.HtmlElement = label.getparent()
+        if label.is_tail:
+            # The label follows a child tag
+            tag = tag.getparent()
+        name, parse = field
+        # Values are kept on the next sibling
+        details[name] = parse(VALUE(tag.getnext()))
+    return details
+
+
+def parse_tab(tab: str, tab_html: lxml.html.HtmlElement) -> tuple:
+    """Parse a single tab of a process.
+
+    ``tab`` is a key of ``urls.details`` and values are returned in the order
+    of ``sql.data.refresh.update``.
+    """
+    if tab == "process":
+        return (parse_process(tab_html),)
+    if tab == "parties":
+        return (parse_parts(tab_html),)
+    details: dict = parse_incident(tab_html)
+    return (details["assuntos"], details["orgao_origem"], details["origem"],
+            details["numeros_origem"])
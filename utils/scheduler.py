@@ -0,0 +1,168 @@
+"""Scheduling of search ids."""
+from math import ceil
+from typing import Dict, List, Optional, Set
+import threading
+import time
+from db.db_leases import LeaseManager
+
+
+class IdScheduler:
+    """Hand out consecutive ids while keeping track of hits in memory.
+
+    Ids are issued as long as they are within a look-ahead window past the
+    last id with processes (a hit). The window is sized to expect
+    ``max_in_flight`` hits, so it grows where hits are sparse and stays small
+    where almost every id has processes, avoiding requests past the end of
+    the id space.
+
+    Scheduling stops once ``max_misses`` consecutive ids after the last hit
+    have no processes or ``limit`` ids were issued.
+
+    Ids finish out of order. ``frontier`` is the first id not finished yet,
+    so all ids from ``start`` to it are done.
+    """
+
+    def __init__(self, start: int, max_in_flight: int, max_misses: int,
+                 limit: Optional[int] = None,
+                 last_hit: Optional[int] = None) -> None:
+        """Initialize state starting from id ``start``.
+
+        ``last_hit`` is the last id known to have processes, when it is not
+        ``start - 1``, so a resumed run keeps the misses of the earlier one.
+        """
+        self.start: int = start
+        self.max_in_flight: int = max_in_flight
+        self.max_misses: int = max_misses
+        self.limit: Optional[int] = limit
+        self.next_id: int = start
+        self.last_hit: int = last_hit if last_hit is not None else start - 1
+        self.in_flight: int = 0
+        self.hits: int = 0
+        # Exponential moving average of hits per id
+        self.density: float = 1.0
+        self.widened: bool = False
+        self.frontier: int = start
+        # Finished ids past the frontier
+        self._finished: Set[int] = set()
+        self._lock = threading.Lock()
+
+    def window(self) -> int:
+        """Return how many ids past the last hit may be issued."""
+        if self.widened:
+            return self.max_misses
+        expected: int = ceil(self.max_in_flight
+                             / max(self.density, 1 / self.max_misses))
+        return min(self.max_misses, max(self.max_in_flight, expected))
+
+    def next(self) -> Optional[int]:
+        """Return the next id to scrap or ``None`` if none can be issued now.
+
+        When nothing is in flight and the window is exhausted, the window is
+        widened to ``max_misses`` to confirm the end of the id space.
+        """
+        with self._lock:
+            if self.limit is not None \
+                    and self.next_id >= self.start + self.limit:
+                return None
+            if self.next_id > self.last_hit + self.window():
+                if self.in_flight or self.widened:
+                    return None
+                self.widened = True
+                if self.next_id > self.last_hit + self.window():
+                    return None
+            id_stf: int = self.next_id
+            self.next_id += 1
+            self.in_flight += 1
+            return id_stf
+
+    def finish(self, id_stf: int, hit: bool) -> None:
+        """Record the result of a scraped id."""
+        with self._lock:
+            self.in_flight -= 1
+            self.density = 0.95 * self.density + 0.05 * hit
+            if hit:
+                self.hits += 1
+                self.widened = False
+                self.last_hit = max(self.last_hit, id_stf)
+            self._finished.add(id_stf)
+            while self.frontier in self._finished:
+                self._finished.remove(self.frontier)
+                self.frontier += 1
+
+
+class LeasedIdScheduler(IdScheduler):
+    """Hand out ids of ranges leased from the database.
+
+    Ranges of ``range_size`` ids are claimed from ``leases`` as they are
+    needed, so workers on many machines can scrap the same id space without
+    repeating ids. A range is marked as done, with its last hit, once all of
+    its ids are scraped.
+
+    The end of the id space is found from the ranges of all workers: new
+    ranges are leased while they begin within ``max_misses`` ids past the last
+    hit of finished ranges. While other workers hold the frontier, this one
+    waits ``poll_interval`` seconds between claims.
+    """
+
+    def __init__(self, leases: LeaseManager, scope: str, start: int,
+                 max_in_flight: int, max_misses: int, range_size: int,
+                 poll_interval: float, limit: Optional[int] = None) -> None:
+        """Initialize state, ranges are only claimed by ``next``."""
+        super().__init__(start, max_in_flight, max_misses, limit)
+        self.leases: LeaseManager = leases
+        self.scope: str = scope
+        self.range_size: int = range_size
+        self.poll_interval: float = poll_interval
+        self.range_end: int = start
+        self.issued: int = 0
+        self.exhausted: bool = False
+        # Start of each range in progress: [end, ids pending, last hit]
+        self.ranges: Dict[int, List[Optional[int]]] = {}
+
+    def next(self) -> Optional[int]:
+        """Return the next id to scrap or ``None`` if none can be issued now.
+
+        Blocks while the ids of this worker are done but other workers may
+        still find processes past the frontier.
+        """
+        with self._lock:
+            if self.limit is not None and self.issued >= self.limit:
+                return None
+            while self.next_id >= self.range_end:
+                if self.exhausted:
+                    return None
+                claimed = self.leases.claim_range(
+                    self.scope, self.start, self.range_size, self.max_misses)
+                if claimed is not None:
+                    self.next_id, self.range_end = claimed
+                    self.ranges[self.next_id] = [
+                        self.range_end, self.range_end - self.next_id, None]
+                elif self.in_flight:
+                    # Ranges of this worker may still move the frontier
+                    return None
+                elif self.leases.active(self.scope):
+                    time.sleep(self.poll_interval)
+                else:
+                    self.exhausted = True
+            id_stf: int = self.next_id
+            self.next_id += 1
+            self.in_flight += 1
+            self.issued += 1
+            return id_stf
+
+    def finish(self, id_stf: int, hit: bool) -> None:
+        """Record the result of a scraped id and complete its range."""
+        with self._lock:
+            self.in_flight -= 1
+            range_start: int = max(start for start in self.ranges
+                                   if start <= id_stf)
+            leased: List[Optional[int]] = self.ranges[range_start]
+            leased[1] -= 1
+            if hit:
+                self.hits += 1
+                self.last_hit = max(self.last_hit, id_stf)
+                leased[2] = max(leased[2] or id_stf, id_stf)
+            if leased[1] == 0:
+                del self.ranges[range_start]
+                self.leases.complete_range(
+                    self.scope, range_start, leased[2])